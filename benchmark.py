@@ -0,0 +1,155 @@
+import numpy as np
+import torch
+import ttn_tools as tt
+import numpy_hamiltonians as nham
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from ttn import TreeTensorNetwork
+
+# Benchmarks of construction, sweeps, energies, observables and I/O on the cpu, every
+# timing is appended as a json line to the output file so runs of different commits
+# can be compared with --compare. Run e.g.
+#     python benchmark.py --configs 16:2 16:3 64:4 --chis 4 8 --backends numpy torch
+
+
+def get_metadata():
+    """ commit, machine and library versions of this run """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads()}
+
+
+def get_network(system_size, cut, chi, backend, profile=False):
+    """ seeded J1-J2 Heisenberg network on the cpu, construction output suppressed """
+    np.random.seed(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return TreeTensorNetwork(system_size=system_size, cut=cut, chilist=[chi]*cut,
+                                 hamiltonian=nham.heisenberg_nn_id(0.5), dimension=2, tree_seed=0,
+                                 backend=backend, ttype=torch.float64, device='cpu', profile=profile)
+
+
+def measure(function, repeats):
+    """ wall times of repeats calls of function """
+    times = []
+    for i in range(repeats):
+        before = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-before)
+    return times
+
+
+def run_config(system_size, cut, chi, backend, repeats):
+    """ {benchmark: times} for one network """
+    results = {}
+    # construction and its sub-steps, from the phases recorded in __init__
+    steps = ['insert_nodes', 'set_bonds', 'get_translations', 'insert_tensors', 'prepare_networks',
+             'add_legs', 'get_orders']
+    for i in range(repeats):
+        before = time.perf_counter()
+        tree_object = get_network(system_size, cut, chi, backend, profile=True)
+        results.setdefault('construction', []).append(time.perf_counter()-before)
+        for sample in tree_object.profile_samples:
+            if sample['name'] in steps:
+                results.setdefault(sample['name'], []).append(sample['duration'])
+    tree_object.profile_samples = None
+    loop_length = tree_object.cut+1
+
+    # the first sweep fills the caches, later sweeps are the steady state
+    with contextlib.redirect_stdout(io.StringIO()):
+        tt.sweep(tree_object, loop_length)
+        results['sweep'] = measure(lambda: tt.sweep(tree_object, loop_length), repeats)
+        results['sweep_energy'] = measure(lambda: tt.get_root_energy(tree_object), repeats)
+        results['get_energy'] = measure(lambda: tt.get_energy(tree_object, tree_object.root), repeats)
+        results['optimize_network'] = measure(lambda: tt.optimize_network(tree_object, 2, 0., 1), 1)
+
+        # observables of the optimized network, spin operators as pairs for the correlators
+        lattice = tree_object.root.lattice
+        plaquette = [lattice[0, 0], lattice[0, 1], lattice[1, 1], lattice[1, 0]]
+        pairs = [[nham.sxi, nham.sxi], [nham.syi, nham.syi], [nham.szi, nham.szi]]
+        results['get_rdm'] = measure(lambda: tt.get_rdm(tree_object, plaquette), repeats)
+        results['n_point_correlator'] = measure(
+            lambda: tt.n_point_correlator(tree_object, [nham.szi]*4, plaquette), repeats)
+        results['plaquette_correlators'] = measure(lambda: tt.plaquette_correlators(tree_object, pairs),
+                                                   repeats)
+        results['bond_correlator'] = measure(lambda: tt.bond_correlator(tree_object, pairs), repeats)
+        results['dimer_dimer_correlator'] = measure(
+            lambda: tt.dimer_dimer_correlator(tree_object, pairs, 'x'), repeats)
+        results['plaquette_plaquette_correlator'] = measure(
+            lambda: tt.plaquette_plaquette_correlator(tree_object, pairs, printf=False), repeats)
+
+        with tempfile.TemporaryDirectory() as folder:
+            results['store_network'] = measure(lambda: tt.store_network(tree_object, folder, 'benchmark'),
+                                               repeats)
+            results['load_network'] = measure(lambda: tt.load_network(
+                folder, 'benchmark', tree_object.file_name+'.pickle', print_load=False), repeats)
+            results['store_compact_network'] = measure(
+                lambda: tt.store_compact_network(tree_object, folder, 'benchmark'), repeats)
+            results['load_compact_tensors'] = measure(lambda: tt.load_compact_tensors(
+                os.path.join(folder, 'benchmark', tree_object.file_name+'.ttn')), repeats)
+    return results
+
+
+def compare(old_file, new_file):
+    """ prints the ratio of the median times of new_file over old_file per benchmark """
+    medians = []
+    for file_name in (old_file, new_file):
+        medians.append({})
+        with open(file_name) as data:
+            for line in data:
+                result = json.loads(line)
+                key = (tuple(sorted(result['config'].items())), result['name'])
+                medians[-1][key] = result['median']
+    print('%-44s %-30s %12s %12s %8s'%('config', 'benchmark', 'old', 'new', 'ratio'))
+    for key in sorted(set(medians[0]) & set(medians[1])):
+        config = ' '.join('%s=%s'%item for item in key[0])
+        old, new = medians[0][key], medians[1][key]
+        print('%-44s %-30s %12.4g %12.4g %8.3f'%(config, key[1], old, new, new/old if old else np.nan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks of the tree tensor network on the cpu')
+    parser.add_argument('--configs', nargs='+', default=['16:2', '16:3', '64:4'],
+                        help='system_size:cut pairs')
+    parser.add_argument('--chis', nargs='+', type=int, default=[4, 8])
+    parser.add_argument('--backends', nargs='+', default=['numpy', 'torch'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='benchmarks/results.jsonl')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two output files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    metadata = get_metadata()
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    for a_config in args.configs:
+        system_size, cut = [int(i) for i in a_config.split(':')]
+        for chi in args.chis:
+            for backend in args.backends:
+                config = {'system_size': system_size, 'cut': cut, 'chi': chi, 'backend': backend}
+                results = run_config(system_size, cut, chi, backend, args.repeats)
+                with open(args.output, 'a') as data:
+                    for name, times in results.items():
+                        data.write(json.dumps({'name': name, 'config': config, 'times': times,
+                                               'min': min(times), 'median': float(np.median(times)),
+                                               **metadata})+'\n')
+                print(config, ' '.join('%s %.3gs'%(name, np.median(times)) for name, times in results.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,55 @@
 import numpy as np
 import torch
+import functools
+import ttn_tools as tt
 
 
-# s_plusi = torch.cuda.FloatTensor([[0,1],[0,0]])
-# s_minusi = torch.cuda.FloatTensor([[0,0],[1,0]])
+# entries of the single site operators, the tensors are built on first use, once per
+# device and dtype, see get_operator()
+matrices = {'szi': [[1., 0], [0, -1.]],
+            'sxi': [[0, 1.], [1., 0]],
+            'syi': [[0, -1.],[1., 0]],
+            'id': [[1., 0],[0, 1.]],
+            's_plusi': [[0,1.],[0,0]],
+            's_minusi': [[0,0],[1.,0]]}
 
 
-def ising_transverse_x_float32(x,l=1.,j=1.0):
-    szi = torch.cuda.FloatTensor([[1., 0], [0, -1.]])
-    sxi = torch.cuda.FloatTensor([[0, 1.], [1., 0]])
-    syi = torch.cuda.FloatTensor([[0, -1.],[1., 0]])
-    id = torch.cuda.FloatTensor([[1., 0],[0, 1.]])
+def get_operator(name, dtype=torch.float64, device=None):
+    """ operator name of matrices as a tensor of dtype on device, see tt.get_device() """
+    return build_operator(name, dtype, tt.get_device(device))
+
+
+@functools.lru_cache(maxsize=None)
+def build_operator(name, dtype, device):
+    return torch.tensor(matrices[name], dtype=dtype, device=device)
+
+
+def ising_transverse_x_float32(x,l=1.,j=1.0, device=None):
+    szi = get_operator('szi', torch.float32, device)
+    sxi = get_operator('sxi', torch.float32, device)
+    id = get_operator('id', torch.float32, device)
 
     return [[[sxi, sxi],1, [-1.*j,-1.*j]],
                 [[szi], 0, [-1.*x]], [[id], 0, [-1.*l]]]
 
 
-def ising_transverse_x_float64(x,l=1.,j=1.0):
+def ising_transverse_x_float64(x,l=1.,j=1.0, device=None):
 
-    szi = torch.cuda.DoubleTensor([[1., 0], [0, -1.]])
-    sxi = torch.cuda.DoubleTensor([[0, 1.], [1., 0]])
-    syi = torch.cuda.DoubleTensor([[0, -1.],[1., 0]])
-    id = torch.cuda.DoubleTensor([[1., 0],[0, 1.]])
+    szi = get_operator('szi', torch.float64, device)
+    sxi = get_operator('sxi', torch.float64, device)
+    id = get_operator('id', torch.float64, device)
 
     return [[[sxi, sxi],1, [-1.*j,-1.*j]],
                 [[szi], 0, [-1.*x]], [[id], 0, [-1.*l]]]
 
 
-def heisenberg_nn_id_float32(j2, j1=1., h=1.):
+def heisenberg_nn_id_float32(j2, j1=1., h=1., device=None):
 
     """ Heisenberg model with j1: <i,j>; j2: <<i,j>> """
-    szi = torch.cuda.FloatTensor([[1., 0], [0, -1.]])
-    id = torch.cuda.FloatTensor([[1., 0],[0, 1.]])
-    s_plusi = torch.cuda.FloatTensor([[0,1.],[0,0]])
-    s_minusi = torch.cuda.FloatTensor([[0,0],[1.,0]])
+    szi = get_operator('szi', torch.float32, device)
+    id = get_operator('id', torch.float32, device)
+    s_plusi = get_operator('s_plusi', torch.float32, device)
+    s_minusi = get_operator('s_minusi', torch.float32, device)
 
     return [[[szi, szi], 1, [.25*j1,.25*j1]],
                 [[s_minusi, s_plusi], 1, [.5*j1,.5*j1]],
@@ -44,13 +60,13 @@ def heisenberg_nn_id_float32(j2, j1=1., h=1.):
                 [[id], 0, [-h]]]
 
 
-def heisenberg_nn_id_float64(j2, j1=1., h=1.):
+def heisenberg_nn_id_float64(j2, j1=1., h=1., device=None):
 
     """ Heisenberg model with j1: <i,j>; j2: <<i,j>> """
-    szi = torch.cuda.DoubleTensor([[1., 0], [0, -1.]])
-    id = torch.cuda.DoubleTensor([[1., 0],[0, 1.]])
-    s_plusi = torch.cuda.DoubleTensor([[0,1.],[0,0]])
-    s_minusi = torch.cuda.DoubleTensor([[0,0],[1.,0]])
+    szi = get_operator('szi', torch.float64, device)
+    id = get_operator('id', torch.float64, device)
+    s_plusi = get_operator('s_plusi', torch.float64, device)
+    s_minusi = get_operator('s_minusi', torch.float64, device)
 
     return [[[szi, szi], 1, [.25*j1,.25*j1]],
                 [[s_minusi, s_plusi], 1, [.5*j1,.5*j1]],
@@ -1,6 +1,12 @@
 import ttn_tools as tt
 import numpy as np
 import torch
+import copy
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
 # import torch_hamiltonians as ham
 
 def run_simulation(*args,**kwargs):
@@ -11,6 +17,144 @@ def run_simulation(*args,**kwargs):
         torch.cuda.empty_cache()
     return
 
+def run_chi_ramp(chilists, *args, **kwargs):
+    """ run_simulation() for every chilist in chilists, each network starting from the
+        converged tensors of the previous one, see tt.embed_network() """
+    if len(chilists) == 0:
+        raise ValueError('chilists is empty, give at least one chilist')
+    previous_network = None
+    for chilist in chilists:
+        temp_network = TreeTensorNetwork(chilist=chilist, **kwargs)
+        if previous_network is not None:
+            tt.embed_network(previous_network, temp_network)
+        tt.optimize_network(temp_network, *args[:-2], printf=True)
+        tt.store_network(temp_network, *args[-2:])
+        previous_network = temp_network
+    if previous_network.backend == 'torch':
+        torch.cuda.empty_cache()
+    return
+
+def load_compact_network(folder_to_check, ham_name, network_name, print_load=True, **kwargs):
+    """ Rebuilds the network stored by tt.store_compact_network() in
+        folder_to_check/ham_name/network_name with the settings and translations it
+        was optimized with, kwargs go to TreeTensorNetwork (e.g. backend, device or
+        path_cache, which makes rebuilding the networks cheap) """
+    header, tensors = tt.load_compact_tensors(os.path.join(folder_to_check, ham_name, network_name))
+    hamiltonian = [[[np.array(operator) for operator in term[0]], term[1], term[2]]
+                   for term in header['hamiltonian']]
+    settings = dict(system_size=header['system_size'], cut=header['cut'], chilist=header['chilist'],
+                    hamiltonian=hamiltonian, dimension=header['dimension'], bc_type=header['bc_type'],
+                    tree_seed=header['tree_seed'], backend=header['backend'],
+                    ttype=getattr(torch, header['ttype'], torch.float32))
+    # files of the first format version hold neither
+    settings.update(header.get('settings', {}))
+    if 'translations' in header:
+        settings['translations'] = header['translations']
+    settings.update(kwargs)
+    temp_network = TreeTensorNetwork(**settings)
+    for layer, tensor in enumerate(tensors):
+        current_tensor = [x for x in temp_network.node_list if x.layer == layer][0].current_tensor
+        tensor = tt.cast(tt.to_backend(tensor, temp_network.backend, device=temp_network.device),
+                         current_tensor.dtype)
+        tt.set_layer_tensor(temp_network, layer, tensor)
+    temp_network.energy_per_sweep_list = header['energy_per_sweep_list']
+    temp_network.current_iteration = header['current_iteration']
+    temp_network.times = header['times']
+    temp_network.file_name = header['file_name']
+    if print_load:
+        print('Network %s loaded'%(temp_network.file_name))
+    return temp_network
+
+def load_best_network(folder_to_check, print_load=True, **criteria):
+    """ Network with the lowest energy among the ones in folder_to_check matching
+        criteria (see tt.query_index()), only that network is loaded """
+    records = tt.query_index(folder_to_check, **criteria)
+    if not records:
+        raise FileNotFoundError('No network in %s matches %s'%(folder_to_check, criteria))
+    record = records[0]
+    if record['network_name'].endswith('.ttn'):
+        return load_compact_network(folder_to_check, record['ham_name'], record['network_name'], print_load)
+    return tt.load_network(folder_to_check, record['ham_name'], record['network_name'], print_load)
+
+# tree of a parameter scan, built once per process, see run_scan()
+scan_template = None
+
+def init_scan_worker(template):
+    global scan_template
+    scan_template = template
+
+def run_scan_point(hamiltonian, tensors, *args):
+    """ optimizes a copy of scan_template for hamiltonian, starting from tensors (one
+        per layer) when given, and stores it like run_simulation() """
+    temp_network = copy.deepcopy(scan_template)
+    temp_network.set_hamiltonian(hamiltonian)
+    if tensors is not None:
+        for layer, tensor in enumerate(tensors):
+            tt.set_layer_tensor(temp_network, layer, tensor)
+    before = time.time()
+    tt.optimize_network(temp_network, *args[:-2])
+    tt.store_network(temp_network, *args[-2:])
+    tensors = [[x for x in temp_network.node_list if x.layer == layer][0].current_tensor
+               for layer in range(temp_network.cut+1)]
+    return tensors, {'energy': temp_network.energy_per_sweep_list[-1],
+                     'iterations': temp_network.current_iteration,
+                     'time': time.time()-before, 'file_name': temp_network.file_name}
+
+def run_scan(hamiltonian_function, parameters, *args, processes=None, **kwargs):
+    """ run_simulation() for hamiltonian_function(parameter) for all parameters, the
+        tree is built once. Points run on a pool of processes; every point after
+        the first ones starts from the converged tensors of the nearest finished
+        point. Results are appended as json lines to scan_results.jsonl next to the
+        stored networks as soon as a point finishes """
+    template = TreeTensorNetwork(hamiltonian=hamiltonian_function(parameters[0]), **kwargs)
+    # tensors warm start other points, so only translations all points share are kept
+    for parameter in parameters[1:]:
+        template.set_hamiltonian(hamiltonian_function(parameter))
+    template.set_hamiltonian(hamiltonian_function(parameters[0]))
+    results_file = os.path.join(args[-2], args[-1], 'scan_results.jsonl')
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    distance = lambda i, j: np.linalg.norm(np.subtract(parameters[i], parameters[j]))
+
+    if processes:
+        executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=init_scan_worker, initargs=(template,))
+    else:
+        init_scan_worker(template)
+    pending, finished, running = list(range(len(parameters))), {}, {}
+    # cold starts spread over the scan keep all processes busy from the start
+    cold_starts = sorted(set(np.linspace(0, len(pending)-1, processes or 1).astype(int).tolist()))
+    while pending or running:
+        while pending and len(running) < (processes or 1):
+            if cold_starts:
+                index, neighbour = cold_starts.pop(0), None
+            else:
+                if not finished:
+                    break
+                index, neighbour = min(((i, j) for i in pending for j in finished),
+                                       key=lambda x: distance(*x))
+            pending.remove(index)
+            job = (hamiltonian_function(parameters[index]),
+                   None if neighbour is None else finished[neighbour], *args)
+            if processes:
+                running[executor.submit(run_scan_point, *job)] = (index, neighbour)
+            else:
+                running[index] = (index, neighbour, run_scan_point(*job))
+        if processes:
+            done = wait(running, return_when=FIRST_COMPLETED)[0]
+            results = [(*running.pop(future), future.result()) for future in done]
+        else:
+            results = [running.pop(index) for index in list(running)]
+        for index, neighbour, (tensors, result) in results:
+            finished[index] = tensors
+            result.update(parameter=np.asarray(parameters[index]).tolist(),
+                          warm_start=None if neighbour is None else np.asarray(parameters[neighbour]).tolist())
+            with open(results_file, 'a') as data:
+                data.write(json.dumps(result)+'\n')
+            print('scan point %s done: %s'%(result['parameter'], result['energy']))
+    if processes:
+        executor.shutdown()
+    return
+
 class Node:
     """Base Node class for TreeTensorNetwork.
        ------------------------------------------------------------------------
@@ -35,6 +179,9 @@ class Node:
         self.horizontal_networks = []
         self.vertical_networks = []
         self.one_site_networks = []
+        self.horizontal_groups = []
+        self.vertical_groups = []
+        self.one_site_groups = []
         self.bralegs = [None]*3
         self.ketlegs =[None]*3
 
@@ -73,7 +220,12 @@ class TreeTensorNetwork:
 
     def __init__(self, system_size, cut = None, chilist = None, hamiltonian = None,
         dimension = None, bc_type = 'closed', tree_seed = None,
-        forbidden_bonds = [], optimize_type = 'greedy', backend = 'torch', ttype = torch.float32):
+        forbidden_bonds = [], optimize_type = 'greedy', backend = 'torch', ttype = torch.float32,
+        cache_environments = True, batch_networks = True, batch_size = None,
+        fuse_hamiltonian = True, translation_symmetry = True, update_solver = 'svd',
+        solver_options = {}, report_updates = False, mixed_precision = False, threads = None,
+        blas_threads = None, device = None, memory_limit = None, profile = False,
+        path_cache = None, path_cache_size = 64*2**20, translations = None):
 
         self.system_size = system_size
         self.root = Node(value='0', layer=0, lattice=np.arange(1,self.system_size+1))
@@ -84,7 +236,34 @@ class TreeTensorNetwork:
         self.optimize_type = optimize_type
 
         self.dimension = dimension
+        # torch tensors live on device, the first gpu if there is one by default, the
+        # operators of hamiltonian are moved there whatever backend they were built with
+        self.device = tt.get_device(device) if backend == 'torch' else None
+        hamiltonian = tt.hamiltonian_to(hamiltonian, backend, ttype, self.device)
         self.hamiltonian = hamiltonian
+        # terms sharing a spacing summed into one operator, contracted once per bond
+        self.fuse_hamiltonian = fuse_hamiltonian
+        self.fused_hamiltonian = tt.fuse_hamiltonian(hamiltonian) if fuse_hamiltonian else hamiltonian
+        # one network per class of translation equivalent bonds, weighted by its size,
+        # translations (site maps) restricts them, e.g. to the ones of a stored network
+        self.translation_symmetry = translation_symmetry
+        self.translations = []
+        # 'svd', 'randomized_svd' or 'newton_schulz', or a list with one per layer
+        self.update_solver = update_solver
+        self.solver_options = solver_options
+        self.report_updates = report_updates
+        self.update_reports = []
+        self.mixed_precision = mixed_precision
+        # independent contractions run on a pool of threads, see tt.map_terms()
+        self.threads = threads
+        self.blas_threads = blas_threads
+        if threads and threads > 1 and backend == 'numpy' and tt.threadpool_limits is None:
+            print('warning: threadpoolctl is not installed, numpy runs every thread on all BLAS '
+                  'cores, install it or set the BLAS thread count (e.g. OMP_NUM_THREADS)')
+        self.executor = None
+        # connections to the processes of a distributed sweep, see tt.start_workers()
+        self.workers = []
+        self.worker_processes = []
         self.backend = backend
         self.ttype = ttype
         self.cut = cut
@@ -93,9 +272,27 @@ class TreeTensorNetwork:
             torch.manual_seed(self.tree_seed)
         self.node_list = []
         self.times = []
+        # timed phases of the sweeps, see tt.phase()
+        self.profile_samples = [] if profile else None
         self.energy_per_sweep_list = []
         self.current_expectation_values = None
         self.current_iteration = 0
+        # blocks of partially contracted environments, one dict per layer
+        self.cache_environments = cache_environments
+        self.environment_cache = {layer: {} for layer in range(self.cut+1)}
+        # networks equal up to a permutation of bottom legs are contracted at once, as
+        # groups from tt.get_network_groups(), their blocks are cached if cache_environments
+        self.batch_networks = batch_networks
+        self.batch_size = batch_size if batch_networks else 1
+        self.group_networks = cache_environments or batch_networks
+        # largest number of elements of an intermediate, bigger contractions are sliced
+        self.memory_limit = memory_limit
+        # file of the persistent cache of contraction paths, see tt.open_path_cache()
+        self.path_cache = path_cache
+        self.path_cache_size = path_cache_size
+        # compiled contractions of reduced density matrices, see tt.get_rdm()
+        self.site_leaves = None
+        self.rdm_plans = {}
 
         self.spacings = np.unique([i[1] for i in self.hamiltonian])
         self.bc_type = str.lower(bc_type)
@@ -108,13 +305,29 @@ class TreeTensorNetwork:
         # self.flatten_lattices()
         # self.forbidden_bonds = self.get_boundary_bonds(self.bc_type)
         # self.set_attributes()
-        self.insert_nodes(self.root)
-        self.set_bonds()
-        for i in self.node_list:
-            self.insert_tensor_v2(i)
-        self.prepare_networks()
-        self.add_legs()
-        self.get_orders()
+        with tt.phase(self, 'insert_nodes'):
+            self.insert_nodes(self.root)
+        with tt.phase(self, 'set_bonds'):
+            self.set_bonds()
+        with tt.phase(self, 'get_translations'):
+            if self.translation_symmetry:
+                candidates = None if translations is None else [{'sites': np.asarray(sites)}
+                                                                for sites in translations]
+                self.translations = tt.get_translations(self, candidates)
+        with tt.phase(self, 'insert_tensors'):
+            for i in self.node_list:
+                self.insert_tensor_v2(i)
+            if self.mixed_precision:
+                self.set_mixed_precision()
+        with tt.phase(self, 'prepare_networks'):
+            self.prepare_networks()
+        with tt.phase(self, 'add_legs'):
+            self.add_legs()
+        with tt.phase(self, 'get_orders'):
+            self.get_orders()
+        self.set_file_name()
+
+    def set_file_name(self):
         self.chi_string = 'chi'+'-'.join([str(i) for i in self.chilist])
         self.file_name = 'N'+str(self.system_size)+'_'+self.chi_string+'_seed'+str(self.tree_seed)
         self.temp_str = ''
@@ -122,10 +335,42 @@ class TreeTensorNetwork:
             for j in i[-1]:
                 self.temp_str+=str(j)
         self.file_name += '_order' + self.temp_str
+
+    def set_hamiltonian(self, hamiltonian):
+        """ Swaps in a hamiltonian with the same spacings and operators acting on the same
+            bonds, e.g. another field value, reusing all networks. Translations the new
+            hamiltonian breaks (e.g. two-site terms no longer symmetric under exchange)
+            are dropped and the networks rebuilt, translations are never added since
+            the tensors may not be symmetric under them. """
+        assert np.array_equal(np.unique([i[1] for i in hamiltonian]), self.spacings), \
+            'the spacings of the hamiltonian can not change'
+        hamiltonian = tt.hamiltonian_to(hamiltonian, self.backend, self.ttype, self.device)
+        self.hamiltonian = hamiltonian
+        self.fused_hamiltonian = tt.fuse_hamiltonian(hamiltonian) if self.fuse_hamiltonian else hamiltonian
+        if self.mixed_precision:
+            self.set_mixed_precision()
+        tt.clear_environment_cache(self)
+        if self.translation_symmetry:
+            translations = tt.get_translations(self, self.translations)
+            if len(translations) != len(self.translations):
+                self.translations = translations
+                self.rebuild_networks()
+        self.energy_per_sweep_list = []
+        self.set_file_name()
     def store_time(self, t):
-        """ method that merely serves to store time using decorator timer()"""
+        """ method that merely serves to store the time of tt.optimize_tensor() """
         self.times.append(t)
 
+    def __getstate__(self):
+        """ cached environments, rdm plans and the thread pool are rebuilt on demand, no
+            need to pickle them, workers are not shared """
+        state = self.__dict__.copy()
+        state['environment_cache'] = {layer: {} for layer in self.environment_cache}
+        state['site_leaves'], state['rdm_plans'] = None, {}
+        state['executor'] = None
+        state['workers'], state['worker_processes'] = [], []
+        return state
+
 
     def insert_nodes(self, node):
         """ docstring for insert_nodes """
@@ -164,41 +409,41 @@ class TreeTensorNetwork:
         if node is self.root:
             node.current_tensor = tt.create_sym_tensor(1,
                 self.chilist[node.layer], self.chilist[node.layer], ttype=self.ttype,
-                backend=self.backend)
+                backend=self.backend, device=self.device)
             node.cache_tensor = tt.create_cache_tensor(1,
                 self.chilist[node.layer], self.chilist[node.layer], ttype=self.ttype,
-                backend=self.backend)
+                backend=self.backend, device=self.device)
 
         elif (node.layer == self.cut) and (node.isLeftChild):
             if node.lattice.flatten().size%2 == 0:
                 node.current_tensor = tt.create_sym_tensor(self.chilist[-1],
                     int(2**(len(node.lattice.flatten())/2)), int(2**(len(node.lattice.flatten())/2)),
-                    ttype=self.ttype, backend=self.backend).reshape(self.chilist[-1],
+                    ttype=self.ttype, backend=self.backend, device=self.device).reshape(self.chilist[-1],
                         *np.ones(len(node.lattice.flatten()), dtype = 'int')*2)
                 node.cache_tensor= tt.create_cache_tensor(self.chilist[-1],
                     int(2**(len(node.lattice.flatten())/2)), int(2**(len(node.lattice.flatten())/2)),
-                    ttype=self.ttype, backend=self.backend).reshape(self.chilist[-1],
+                    ttype=self.ttype, backend=self.backend, device=self.device).reshape(self.chilist[-1],
                         *np.ones(len(node.lattice.flatten()), dtype = 'int')*2)
             else:
                 # print('not mod 2')
                 node.current_tensor = (tt.create_tensor(self.chilist[-1],
                                     int(2**(node.lattice.size)), ttype=self.ttype,
-                                    backend=self.backend).
+                                    backend=self.backend, device=self.device).
                                     reshape(self.chilist[-1],*np.ones(node.lattice
                                     .size, dtype = 'int')*2))
                 node.cache_tensor = (tt.create_cache_tensor(self.chilist[-1],
                                     int(2**(node.lattice.size)), ttype=self.ttype,
-                                    backend=self.backend).
+                                    backend=self.backend, device=self.device).
                                     reshape(self.chilist[-1],*np.ones(node.lattice
                                     .size, dtype = 'int')*2))
 
         elif (node.layer != self.cut) and (node.isLeftChild) and (node is not self.root):
             node.current_tensor = tt.create_sym_tensor(self.chilist[node.parent.layer],
                 self.chilist[node.layer], self.chilist[node.layer], ttype=self.ttype,
-                backend=self.backend)
+                backend=self.backend, device=self.device)
             node.cache_tensor = tt.create_cache_tensor(self.chilist[node.parent.layer],
                 self.chilist[node.layer], self.chilist[node.layer], ttype=self.ttype,
-                backend=self.backend)
+                backend=self.backend, device=self.device)
 
         # all nodes within a layer have the same tensor!
         for another_node in self.node_list:
@@ -206,6 +451,24 @@ class TreeTensorNetwork:
                 another_node.current_tensor = node.current_tensor
                 another_node.cache_tensor = node.cache_tensor
 
+    def set_mixed_precision(self):
+        """ Contractions run in the low precision type, ttype for torch and float32 for
+            numpy, while cache tensors, and with them the accumulated environments and
+            the update of optimize_tensor(), are float64. The new tensors are cast back
+            by update_tensor(), energies are accumulated as python floats. """
+        if self.backend == 'torch':
+            low, high = self.ttype, torch.float64
+        else:
+            low, high = np.float32, np.float64
+        for layer in range(self.cut+1):
+            nodes = [node for node in self.node_list if node.layer == layer]
+            current_tensor = tt.cast(nodes[0].current_tensor, low)
+            cache_tensor = tt.cast(nodes[0].cache_tensor, high)
+            for node in nodes:
+                node.current_tensor, node.cache_tensor = current_tensor, cache_tensor
+        self.fused_hamiltonian = [[[tt.cast(operator, low) for operator in term[0]], *term[1:]]
+                                  for term in self.fused_hamiltonian]
+
     def insert_tensor(self, node):
         """ Inserts tensors in the node attribute 'current_tensor' given bond dimension list
             named 'chilist.'"""
@@ -246,59 +509,138 @@ class TreeTensorNetwork:
 
     def set_bonds(self):
         """ Method to be placed in init of class """
+        positions = tt.get_site_positions(self.root.lattice)
         for i in self.node_list:
-            temp_bonds = tt.get_bonds(self.root.lattice, i.lattice, self.spacings)
+            temp_bonds = tt.get_bonds(self.root.lattice, i.lattice, self.spacings, positions)
             (i.horizontal_two_site_terms, i.vertical_two_site_terms, i.one_site_terms,
             i.vertical_bc_terms, i.horizontal_bc_terms) = temp_bonds
             # print(type(i.horizontal_two_site_terms))
 
 
     def get_orders(self):
+        path_cache = tt.open_path_cache(self.path_cache, self.path_cache_size) if self.path_cache else None
         for node in self.node_list:
             for network in node.vertical_networks:
-                tt.get_optimal_order(node, network, self.optimize_type)
+                tt.get_optimal_order(node, network, self.optimize_type, self.memory_limit, path_cache)
             for network in node.horizontal_networks:
-                tt.get_optimal_order(node, network, self.optimize_type)
+                tt.get_optimal_order(node, network, self.optimize_type, self.memory_limit, path_cache)
             for network in node.one_site_networks:
-                tt.get_optimal_order(node, network, self.optimize_type)
-
+                tt.get_optimal_order(node, network, self.optimize_type, self.memory_limit, path_cache)
+            if self.group_networks:
+                node.vertical_groups = tt.get_network_groups(node.vertical_networks, self.batch_size)
+                node.horizontal_groups = tt.get_network_groups(node.horizontal_networks, self.batch_size)
+                node.one_site_groups = tt.get_network_groups(node.one_site_networks, self.batch_size)
+                for group in node.vertical_groups + node.horizontal_groups + node.one_site_groups:
+                    tt.get_environment_plan(node, group, self.optimize_type, self.memory_limit, path_cache)
+        if path_cache is not None:
+            print('contraction paths: %s from %s, %s searched'%(path_cache['hits'], self.path_cache,
+                                                                 path_cache['misses']))
+            tt.close_path_cache(path_cache)
+
+
+    def cost_report(self, printf=True):
+        """ Flops and largest intermediates (elements and bytes) of the contractions,
+            from the paths of tt.get_optimal_order(), per node and bond type and, for
+            the nodes a sweep optimizes (root, root.left, ...), per layer, per bond type
+            and per sweep. The energy of a sweep comes with the root environment, a
+            full tt.get_energy() costs 'energy_flops' """
+        itemsize = (self.root.current_tensor.itemsize if self.backend == 'numpy'
+                    else self.root.current_tensor.element_size())
+        report = {'nodes': {}, 'layers': {}, 'bond_types': {}, 'sweep': {}}
+
+        def add(total, cost):
+            for key, value in cost.items():
+                if 'largest' in key:
+                    total[key] = max(total.get(key, 0), value)
+                else:
+                    total[key] = total.get(key, 0) + value
+
+        sweep_values = []
+        temp = self.root
+        for i in range(self.cut+1):
+            sweep_values.append(temp.value)
+            temp = temp.left
+        for node in self.node_list:
+            costs = tt.get_cost(self, node)
+            report['nodes'][node.value] = costs
+            if node.value not in sweep_values:
+                continue
+            for kind, cost in costs.items():
+                add(report['layers'].setdefault(node.layer, {}), cost)
+                add(report['bond_types'].setdefault(kind, {}), cost)
+                add(report['sweep'], cost)
+        for total in [report['sweep']]+list(report['layers'].values())+list(report['bond_types'].values()):
+            total['peak_bytes'] = total['largest_intermediate']*itemsize
+        report['sweep']['energy_flops'] = sum(cost['energy_flops'] for cost in
+                                              report['nodes'][self.root.value].values())
+        if printf:
+            print('%-12s %10s %14s %14s %12s'%('', 'networks', 'flops', 'largest', 'peak bytes'))
+            for layer, total in sorted(report['layers'].items()):
+                print('%-12s %10s %14.4g %14s %12.4g'%('layer %s'%layer, total['networks'], total['flops'],
+                      total['largest_intermediate'], total['peak_bytes']))
+            for kind, total in report['bond_types'].items():
+                print('%-12s %10s %14.4g %14s %12.4g'%(kind, total['networks'], total['flops'],
+                      total['largest_intermediate'], total['peak_bytes']))
+            total = report['sweep']
+            print('%-12s %10s %14.4g %14s %12.4g'%('sweep', total['networks'], total['flops'],
+                  total['largest_intermediate'], total['peak_bytes']))
+        return report
 
     def tensors_to(self, chip_type):
-
+        """ moves the tensors and operators of the network onto device chip_type """
         if self.backend == 'torch':
-            for node in self.node_list:
-                print('loading Node %s onto %s'%(node.value, chip_type))
-                node.current_tensor = node.current_tensor.to(device=chip_type)
-                # node.cache_tensor.to("cuda")
-                print('Node %s its tensor loaded onto %s'%(node.value, chip_type))
+            self.device = tt.get_device(chip_type)
+            for layer in range(self.cut+1):
+                nodes = [node for node in self.node_list if node.layer == layer]
+                print('loading layer %s onto %s'%(layer, chip_type))
+                current_tensor = nodes[0].current_tensor.to(device=self.device)
+                cache_tensor = nodes[0].cache_tensor.to(device=self.device)
+                for node in nodes:
+                    node.current_tensor, node.cache_tensor = current_tensor, cache_tensor
+            self.hamiltonian = tt.hamiltonian_to(self.hamiltonian, self.backend, device=self.device)
+            self.fused_hamiltonian = tt.hamiltonian_to(self.fused_hamiltonian, self.backend,
+                                                       device=self.device)
+            tt.clear_environment_cache(self)
         else:
             print("try using torch as 'backend'")
             return
 
 
+    def rebuild_networks(self):
+        """ networks, groups and contraction paths built again, e.g. for new translations """
+        for node in self.node_list:
+            node.vertical_networks, node.horizontal_networks, node.one_site_networks = [], [], []
+            node.vertical_groups, node.horizontal_groups, node.one_site_groups = [], [], []
+        self.prepare_networks()
+        self.add_legs()
+        self.get_orders()
+
     def add_legs(self):
         """ Docstring for add_legs """
         for node in self.node_list:
-            tt.get_legs(self.cut, node, node.vertical_networks)
-            tt.get_legs(self.cut, node, node.horizontal_networks)
-            tt.get_legs(self.cut, node, node.one_site_networks)
+            tt.get_legs(self.cut, node, node.vertical_networks, self.fuse_hamiltonian)
+            tt.get_legs(self.cut, node, node.horizontal_networks, self.fuse_hamiltonian)
+            tt.get_legs(self.cut, node, node.one_site_networks, self.fuse_hamiltonian)
 
     def prepare_networks(self):
         """ Docstring for prepare_networks """
         # can't zip since lengths of lists can differ in size
+        bond_index = tt.get_bond_index(self.node_list)
         for node in self.node_list:
-            for bondspace, bondlist in node.vertical_two_site_terms.items():
-                for a_bond in bondlist:
-                    node.vertical_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond))
-            for bondspace, bondlist in node.horizontal_two_site_terms.items():
-                for a_bond in bondlist:
-                    node.horizontal_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond))
-            for bondspace, bondlist in node.vertical_bc_terms.items():
-                for a_bond in bondlist:
-                    node.vertical_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond))
-            for bondspace, bondlist in node.horizontal_bc_terms.items():
-                for a_bond in bondlist:
-                    node.horizontal_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond))
+            for bondspace in node.vertical_two_site_terms:
+                bonds = node.vertical_two_site_terms[bondspace] + node.vertical_bc_terms[bondspace]
+                for a_bond, multiplicity in tt.get_bond_classes(self, node, bonds):
+                    node.vertical_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond, bond_index))
+                    node.vertical_networks[-1]['multiplicity'] = multiplicity
+                    node.vertical_networks[-1]['kind'] = 'vertical'
+            for bondspace in node.horizontal_two_site_terms:
+                bonds = node.horizontal_two_site_terms[bondspace] + node.horizontal_bc_terms[bondspace]
+                for a_bond, multiplicity in tt.get_bond_classes(self, node, bonds):
+                    node.horizontal_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond, bond_index))
+                    node.horizontal_networks[-1]['multiplicity'] = multiplicity
+                    node.horizontal_networks[-1]['kind'] = 'horizontal'
             for bondspace, bondlist in node.one_site_terms.items():
-                for a_bond in bondlist:
-                    node.one_site_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond))
+                for a_bond, multiplicity in tt.get_bond_classes(self, node, bondlist):
+                    node.one_site_networks.append(tt.get_single_network(self.node_list, bondspace, a_bond, bond_index))
+                    node.one_site_networks[-1]['multiplicity'] = multiplicity
+                    node.one_site_networks[-1]['kind'] = 'one_site'
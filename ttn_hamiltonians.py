@@ -1,14 +1,17 @@
 import numpy as np
 import torch
+from torch_hamiltonians import get_operator
 
-szi = torch.cuda.DoubleTensor([[1., 0], [0, -1.]])
-sxi = torch.cuda.DoubleTensor([[0, 1.], [1., 0]])
-syi = torch.cuda.DoubleTensor([[0, -1.],[1., 0]])
-id = torch.cuda.DoubleTensor([[1., 0],[0, 1.]])
-s_plusi = torch.cuda.DoubleTensor([[0,1],[0,0]])
-s_minusi = torch.cuda.DoubleTensor([[0,0],[1,0]])
 
+def __getattr__(name):
+    """ szi, sxi, syi, id, s_plusi and s_minusi as float64 tensors on the default
+        device, built on first access instead of at import """
+    if name in ('szi', 'sxi', 'syi', 'id', 's_plusi', 's_minusi'):
+        return get_operator(name)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
 
-def ising_transverse_x(x,l=1.,j=1.0,):
+
+def ising_transverse_x(x,l=1.,j=1.0,device=None):
+    sxi, szi, id = (get_operator(name, device=device) for name in ('sxi', 'szi', 'id'))
     return [[[sxi, sxi],1, [-1.*j,-1.*j]],
                 [[szi], 0, [-1.*x]], [[id], 0, [-1.*l]]]
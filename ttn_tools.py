@@ -9,6 +9,19 @@ import os
 import itertools as it
 import functools
 import gc
+import contextlib
+import threading
+import json
+import hashlib
+import sqlite3
+import struct
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
 ################################################################################
 # TOOLS FOR TTN file                                                           #
@@ -19,18 +32,115 @@ import gc
 
 torch.set_printoptions(10)
 
-def timer(func):
-    """ Wrapper for store_time method of class TreeTensorNetwork, times optimization
-        of a single tensor (Environments + SVD)"""
-    @functools.wraps(func)
-    def f(*args, **kwargs):
-        before = time.time()
-        rv = func(*args, **kwargs)
-        after = time.time()
-        args[0].store_time(after - before)
-        # print(after-before)
-        return rv
-    return f
+def phase(tree_object, name, **args):
+    """ Context timing the phase name (with args) of tree_object when it profiles,
+        see TreeTensorNetwork(profile=True), otherwise a shared no-op context """
+    if tree_object.profile_samples is None:
+        return no_phase
+    return timed_phase(tree_object, name, args)
+
+
+no_phase = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def timed_phase(tree_object, name, args):
+    """ appends {name, start, duration, thread, args} to tree_object.profile_samples,
+        gpu work is synchronized before the clock is read """
+    synchronize(tree_object)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        synchronize(tree_object)
+        tree_object.profile_samples.append({'name': name, 'start': start,
+                                            'duration': time.perf_counter()-start,
+                                            'thread': threading.get_ident(), 'args': args})
+
+
+def synchronize(tree_object):
+    """ waits for the queued gpu work of tree_object """
+    if tree_object.backend == 'torch' and tree_object.device.type == 'cuda':
+        torch.cuda.synchronize(tree_object.device)
+
+
+def get_profile(tree_object):
+    """ {phase: {calls, total, mean, max}} of the profile samples of tree_object, the
+        environments per bond type are the phases 'environment_<kind>' """
+    profile = {}
+    for sample in tree_object.profile_samples:
+        summary = profile.setdefault(sample['name'], {'calls': 0, 'total': 0., 'max': 0.})
+        summary['calls'] += 1
+        summary['total'] += sample['duration']
+        summary['max'] = max(summary['max'], sample['duration'])
+    for summary in profile.values():
+        summary['mean'] = summary['total']/summary['calls']
+    return profile
+
+
+def store_profile(tree_object, file_name):
+    """ Stores the profile samples of tree_object and their summary, see get_profile(),
+        as json """
+    with open(file_name, 'w') as data:
+        json.dump({'summary': get_profile(tree_object), 'samples': tree_object.profile_samples},
+                  data, indent=1, default=str)
+
+
+def store_chrome_trace(tree_object, file_name):
+    """ Stores the profile samples of tree_object in the Chrome trace event format,
+        for chrome://tracing or Perfetto """
+    events = [{'name': sample['name'], 'ph': 'X', 'ts': sample['start']*1e6,
+               'dur': sample['duration']*1e6, 'pid': os.getpid(), 'tid': sample['thread'],
+               'args': {key: str(value) for key, value in sample['args'].items()}}
+              for sample in tree_object.profile_samples]
+    with open(file_name, 'w') as data:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, data)
+
+
+def store_checkpoint(tree_object, file_name, state):
+    """ Stores the tensor of every layer, the times, energies and update reports of
+        tree_object and the loop state of optimize_network() in file_name. Written to
+        a temporary file first and moved over file_name, so an interrupted write
+        leaves the previous checkpoint intact """
+    checkpoint = dict(state)
+    checkpoint['tensors'] = [[a_node for a_node in tree_object.node_list if a_node.layer == layer][0].current_tensor
+                             for layer in range(tree_object.cut+1)]
+    checkpoint['times'] = tree_object.times
+    checkpoint['energy_per_sweep_list'] = tree_object.energy_per_sweep_list
+    checkpoint['update_reports'] = tree_object.update_reports
+    # the randomized svd update draws from these
+    checkpoint['numpy_random_state'] = np.random.get_state()
+    checkpoint['torch_random_state'] = torch.get_rng_state()
+    if torch.cuda.is_available():
+        checkpoint['cuda_random_state'] = torch.cuda.get_rng_state_all()
+    folder = os.path.dirname(os.path.abspath(file_name))
+    os.makedirs(folder, exist_ok=True)
+    temp_file = file_name+'.tmp'
+    with phase(tree_object, 'store_checkpoint'):
+        with open(temp_file, 'wb') as data:
+            pickle.dump(checkpoint, data)
+            data.flush()
+            os.fsync(data.fileno())
+        os.replace(temp_file, file_name)
+
+
+def load_checkpoint(tree_object, file_name):
+    """ Restores tree_object from a checkpoint written by store_checkpoint() and
+        returns the loop state of optimize_network() """
+    with phase(tree_object, 'load_checkpoint'), open(file_name, 'rb') as data:
+        checkpoint = pickle.load(data)
+    for layer, tensor in enumerate(checkpoint.pop('tensors')):
+        set_layer_tensor(tree_object, layer, tensor)
+    tree_object.times = checkpoint.pop('times')
+    tree_object.energy_per_sweep_list = checkpoint.pop('energy_per_sweep_list')
+    tree_object.update_reports = checkpoint.pop('update_reports')
+    np.random.set_state(checkpoint.pop('numpy_random_state'))
+    torch.set_rng_state(checkpoint.pop('torch_random_state'))
+    cuda_random_state = checkpoint.pop('cuda_random_state', None)
+    if cuda_random_state is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(cuda_random_state)
+    print('Checkpoint %s loaded at iteration %s'%(file_name, checkpoint['counter']))
+    return checkpoint
 
 
 def store_network(tree_object, folder_to_store, ham_name):
@@ -48,8 +158,9 @@ def store_network(tree_object, folder_to_store, ham_name):
     file_name = tree_object.file_name+'.pickle'
     file_name = temp_folder+'/'+file_name
 
-    with open(file_name, 'wb') as data:
+    with phase(tree_object, 'store_network'), open(file_name, 'wb') as data:
         pickle.dump(tree_object, data)
+    append_index(folder_to_store, get_index_record(tree_object, ham_name, tree_object.file_name+'.pickle'))
     print('Network stored in %s as %s'%(network_folder, tree_object.file_name+'.pickle'))
 
 
@@ -70,27 +181,227 @@ def load_network(folder_to_check, ham_name, network_name, print_load=True):
         return tree_object
 
 
-def create_cache_tensor(*dims, ttype, backend='torch'):
+# compact network files: magic, format version and header length, a json header and
+# the tensor of every layer as a raw array, aligned for memory-mapping
+COMPACT_MAGIC = b'TTNC'
+COMPACT_VERSION = 1
+COMPACT_ALIGNMENT = 64
+
+
+def align(offset):
+    return -(-offset//COMPACT_ALIGNMENT)*COMPACT_ALIGNMENT
+
+
+def store_compact_network(tree_object, folder_to_store, ham_name):
+    """ Stores the tensor of every layer of tree_object once, as a raw array, with a
+        header holding what is needed to rebuild the tree (system_size, cut, chilist,
+        hamiltonian, seed, ...), the settings it was optimized with, the site maps of
+        its translations and its energy history, in folder_to_store/ham_name as
+        file_name.ttn. Load with load_compact_tensors() or ttn.load_compact_network() """
+    temp_folder = os.path.join(folder_to_store, ham_name)
+    os.makedirs(temp_folder, exist_ok=True)
+    file_name = os.path.join(temp_folder, tree_object.file_name+'.ttn')
+    arrays = [np.ascontiguousarray(to_backend([a_node for a_node in tree_object.node_list
+                                               if a_node.layer == layer][0].current_tensor, 'numpy'))
+              for layer in range(tree_object.cut+1)]
+    tensors, offset = [], 0
+    for array in arrays:
+        tensors.append({'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset = align(offset+array.nbytes)
+    header = {'version': COMPACT_VERSION, 'system_size': tree_object.system_size, 'cut': tree_object.cut,
+              'chilist': [int(i) for i in tree_object.chilist], 'dimension': tree_object.dimension,
+              'bc_type': tree_object.bc_type, 'tree_seed': tree_object.tree_seed,
+              'backend': tree_object.backend, 'ttype': str(tree_object.ttype).replace('torch.', ''),
+              'hamiltonian': [[[to_backend(operator, 'numpy').tolist() for operator in term[0]],
+                               float(term[1]), [float(i) for i in term[-1]]]
+                              for term in tree_object.hamiltonian],
+              'settings': {'translation_symmetry': tree_object.translation_symmetry,
+                           'fuse_hamiltonian': tree_object.fuse_hamiltonian,
+                           'optimize_type': tree_object.optimize_type,
+                           'memory_limit': tree_object.memory_limit,
+                           'mixed_precision': tree_object.mixed_precision,
+                           'update_solver': tree_object.update_solver,
+                           'solver_options': tree_object.solver_options},
+              'translations': [[int(i) for i in g['sites']] for g in tree_object.translations],
+              'file_name': tree_object.file_name,
+              'energy_per_sweep_list': [float(i) for i in tree_object.energy_per_sweep_list],
+              'current_iteration': tree_object.current_iteration, 'times': tree_object.times,
+              'tensors': tensors}
+    header = json.dumps(header).encode()
+    start = align(16+len(header))
+    temp_file = file_name+'.tmp'
+    with phase(tree_object, 'store_network'):
+        with open(temp_file, 'wb') as data:
+            data.write(struct.pack('<4sIQ', COMPACT_MAGIC, COMPACT_VERSION, len(header)))
+            data.write(header)
+            for array, tensor in zip(arrays, tensors):
+                data.write(b'\0'*(start+tensor['offset']-data.tell()))
+                data.write(array.tobytes())
+        os.replace(temp_file, file_name)
+    append_index(folder_to_store, get_index_record(tree_object, ham_name, tree_object.file_name+'.ttn'))
+    print('Network stored in %s as %s'%(temp_folder+'/', tree_object.file_name+'.ttn'))
+
+
+def load_compact_tensors(file_name):
+    """ (header, tensors) of a file written by store_compact_network(), the tensors
+        (one per layer) are copy-on-write memory maps of the file, nothing is read
+        until they are used """
+    with open(file_name, 'rb') as data:
+        magic, version, length = struct.unpack('<4sIQ', data.read(16))
+        if magic != COMPACT_MAGIC:
+            raise ValueError('%s is not a compact network file'%file_name)
+        if version > COMPACT_VERSION:
+            raise ValueError('%s has format version %s, this code reads up to %s'%(
+                file_name, version, COMPACT_VERSION))
+        header = json.loads(data.read(length))
+    start = align(16+length)
+    tensors = [np.memmap(file_name, dtype=tensor['dtype'], mode='c', offset=start+tensor['offset'],
+                         shape=tuple(tensor['shape'])) for tensor in header['tensors']]
+    return header, tensors
+
+
+# every store appends a line with the settings and results of the network to the index
+# of folder_to_store, so stored networks can be found without loading them
+RESULTS_INDEX = 'index.jsonl'
+
+
+def get_index_record(tree_object, ham_name, network_name):
+    """ index entry of tree_object stored as folder/ham_name/network_name, time is the
+        time spent in optimize_tensor() """
+    return {'ham_name': ham_name, 'network_name': network_name, 'system_size': tree_object.system_size,
+            'cut': tree_object.cut, 'chilist': [int(i) for i in tree_object.chilist],
+            'tree_seed': tree_object.tree_seed,
+            'hamiltonian': [[float(term[1]), [float(i) for i in term[-1]]] for term in tree_object.hamiltonian],
+            'energy': float(tree_object.energy_per_sweep_list[-1]) if tree_object.energy_per_sweep_list else None,
+            'iterations': tree_object.current_iteration, 'time': float(np.sum(tree_object.times)),
+            'stored': time.time()}
+
+
+def append_index(folder_to_store, record):
+    """ appends record to the index of folder_to_store with a single write, so processes
+        storing in the same folder do not interleave their lines """
+    os.makedirs(folder_to_store, exist_ok=True)
+    descriptor = os.open(os.path.join(folder_to_store, RESULTS_INDEX), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(descriptor, (json.dumps(record)+'\n').encode())
+    finally:
+        os.close(descriptor)
+
+
+def read_index(folder_to_check):
+    """ latest index entry of every stored network in folder_to_check, a network stored
+        again replaces its earlier entry and unreadable lines (an interrupted write) are
+        skipped """
+    records = {}
+    if not os.path.exists(os.path.join(folder_to_check, RESULTS_INDEX)):
+        return []
+    with open(os.path.join(folder_to_check, RESULTS_INDEX)) as data:
+        for line in data:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[(record['ham_name'], record['network_name'])] = record
+    return list(records.values())
+
+
+def query_index(folder_to_check, **criteria):
+    """ index entries in folder_to_check matching all criteria, sorted by energy, a
+        criterion is a value the entry must equal or a function of the entry's value
+        returning a bool, e.g.
+            query_index(folder, system_size=64, chilist=[400]*4,
+                        hamiltonian=lambda h: h[3][1][0] == .5*.5)  # j2 = .5 of heisenberg_nn_id """
+    def matches(record):
+        for key, value in criteria.items():
+            if callable(value):
+                if not value(record.get(key)):
+                    return False
+            elif record.get(key) != (list(value) if isinstance(value, tuple) else value):
+                return False
+        return True
+    records = [record for record in read_index(folder_to_check) if matches(record)]
+    return sorted(records, key=lambda record: np.inf if record['energy'] is None else record['energy'])
+
+
+def build_index(folder_to_check):
+    """ adds every network in folder_to_check/*/ stored before the index existed to the
+        index, this loads each of them once """
+    indexed = set((record['ham_name'], record['network_name']) for record in read_index(folder_to_check))
+    for ham_name in sorted(os.listdir(folder_to_check)):
+        if not os.path.isdir(os.path.join(folder_to_check, ham_name)):
+            continue
+        for network_name in sorted(os.listdir(os.path.join(folder_to_check, ham_name))):
+            if (ham_name, network_name) in indexed or not network_name.endswith(('.pickle', '.ttn')):
+                continue
+            if network_name.endswith('.pickle'):
+                tree_object = load_network(folder_to_check, ham_name, network_name, print_load=False)
+                append_index(folder_to_check, get_index_record(tree_object, ham_name, network_name))
+            else:
+                header = load_compact_tensors(os.path.join(folder_to_check, ham_name, network_name))[0]
+                energies = header['energy_per_sweep_list']
+                append_index(folder_to_check, {
+                    'ham_name': ham_name, 'network_name': network_name, 'system_size': header['system_size'],
+                    'cut': header['cut'], 'chilist': header['chilist'], 'tree_seed': header['tree_seed'],
+                    'hamiltonian': [[term[1], term[2]] for term in header['hamiltonian']],
+                    'energy': energies[-1] if energies else None, 'iterations': header['current_iteration'],
+                    'time': float(np.sum(header['times'])), 'stored': os.path.getmtime(
+                        os.path.join(folder_to_check, ham_name, network_name))})
+
+
+def get_device(device=None):
+    """ torch device for device, None picks the first gpu when there is one and the cpu
+        otherwise """
+    if device is None:
+        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def to_backend(tensor, backend, ttype=None, device=None):
+    """ tensor (numpy array or torch tensor) as an array of backend, for torch of type
+        ttype on device. Returns tensor itself when nothing changes """
+    if backend == 'numpy':
+        if isinstance(tensor, np.ndarray):
+            return tensor
+        return tensor.detach().cpu().numpy()
+    if isinstance(tensor, np.ndarray):
+        tensor = torch.from_numpy(tensor)
+    return tensor.to(dtype=ttype or tensor.dtype, device=get_device(device))
+
+
+def hamiltonian_to(hamiltonian, backend, ttype=None, device=None):
+    """ hamiltonian with its operators moved to backend, see to_backend() """
+    return [[[to_backend(operator, backend, ttype, device) for operator in term[0]], *term[1:]]
+            for term in hamiltonian]
+
+
+def create_cache_tensor(*dims, ttype, backend='torch', device=None):
     for i in dims:
         if type(i) == float:
             print(i, type(i))
             print("type is not int m8")
             raise TypeError
     if backend == 'torch':
-        tens = torch.zeros(*dims, dtype=ttype, device='cuda:0')
+        tens = torch.zeros(*dims, dtype=ttype, device=get_device(device))
     elif backend == 'numpy':
         tens = np.zeros(dims)
     return tens
 
 
-def create_tensor(*dims, ttype, backend='torch'):
+def cast(tensor, dtype):
+    """ tensor as dtype, for numpy arrays and torch tensors alike """
+    if isinstance(tensor, np.ndarray):
+        return tensor.astype(dtype, copy=False)
+    return tensor.to(dtype)
+
+
+def create_tensor(*dims, ttype, backend='torch', device=None):
     for i in dims:
         if type(i) == float:
             print(i, type(i))
             print("type is not int m8")
             raise TypeError
     if backend == 'torch':
-        tens = torch.rand(*dims, dtype=ttype, device='cuda:0')
+        tens = torch.rand(*dims, dtype=ttype, device=get_device(device))
         tens = tens.T.svd(some=True)[0]
         tens = tens.T.reshape(*dims)
     elif backend == 'numpy':
@@ -99,7 +410,7 @@ def create_tensor(*dims, ttype, backend='torch'):
     return tens
 
 
-def create_sym_tensor(*dims, ttype, backend='torch'):
+def create_sym_tensor(*dims, ttype, backend='torch', device=None):
     """ docstring for create_sym_tensor """
     for i in dims:
         if type(i) == float:
@@ -118,9 +429,11 @@ def create_sym_tensor(*dims, ttype, backend='torch'):
         # so random_(0,1) just fills the tensor with 1 1 and the rest 0:
         # resulted in a "bug" where by accidant ising worked but heisenberg did not
         # anyhow, it is fixed now...
-        tens = torch.ones(*dims, dtype = ttype, device='cuda:0').random_(0,10)
+        tens = torch.ones(*dims, dtype = ttype, device=get_device(device)).random_(0,10)
 
-        tens.add_(tens.transpose(2,1))
+        # out of place, adding a transposed view of tens to itself in place reads
+        # entries that were already overwritten
+        tens = tens + tens.transpose(2,1)
         # transpose is need, for explanation see:
         # https://github.com/pytorch/pytorch/issues/24900
         tens = tens.reshape(dims[0],dims[1]*dims[1]).T
@@ -141,8 +454,68 @@ def create_sym_tensor(*dims, ttype, backend='torch'):
     return tens
 
 
-def get_bonds(lattice, sub_lattice, spacings):
-    """ docstring for get_bonds """
+def pad_isometry(tensor, shape, symmetric=False):
+    """ Embeds an isometry, rows (first leg) orthonormal, into a larger shape. The
+        old entries are padded with zeros and the new rows are random, orthonormalized
+        against the old ones. With symmetric the new rows are symmetric in the two
+        child legs, like create_sym_tensor(), as long as there is room for them. """
+    old_rows, new_rows = tensor.shape[0], shape[0]
+    columns = int(np.prod(shape[1:]))
+    numpy = isinstance(tensor, np.ndarray)
+    if numpy:
+        padded = np.zeros(shape, dtype=tensor.dtype)
+    else:
+        padded = torch.zeros(shape, dtype=tensor.dtype, device=tensor.device)
+    padded[tuple(slice(0, i) for i in tensor.shape)] = tensor
+    if new_rows == old_rows:
+        return padded
+
+    matrix = padded.reshape(new_rows, columns)
+    for symmetrize in ([True, False] if symmetric else [False]):
+        if numpy:
+            random = np.random.uniform(-1, 1, [new_rows-old_rows, *shape[1:]])
+        else:
+            random = torch.rand(new_rows-old_rows, *shape[1:], dtype=tensor.dtype,
+                                device=tensor.device)*2-1
+        if symmetrize:
+            random = random + (random.transpose(0, 2, 1) if numpy else random.permute(0, 2, 1))
+        random = random.reshape(-1, columns)
+        random = random - (random@matrix[:old_rows].T)@matrix[:old_rows]
+        q, r = np.linalg.qr(random.T) if numpy else torch.linalg.qr(random.T)
+        diagonal = abs(r.diagonal()) if numpy else r.diagonal().abs()
+        # the old rows may leave too little room among the symmetric rows
+        if float(diagonal.min()) > 1e-8*float(diagonal.max()):
+            break
+    matrix[old_rows:] = q.T
+    return padded
+
+
+def embed_network(tree_object, new_tree_object):
+    """ Warm start of new_tree_object, with the same lattice and cut but larger bond
+        dimensions, from the tensors of tree_object. The padded isometries describe
+        the very same state, the new directions only enter through the next updates """
+    for layer in range(tree_object.cut+1):
+        old_tensor = [x for x in tree_object.node_list if x.layer == layer][0].current_tensor
+        new_tensor = [x for x in new_tree_object.node_list if x.layer == layer][0].current_tensor
+        if any(i > j for i, j in zip(old_tensor.shape, new_tensor.shape)):
+            raise ValueError('bond dimensions can only grow, layer %s: %s to %s'
+                             %(layer, tuple(old_tensor.shape), tuple(new_tensor.shape)))
+        symmetric = not [x for x in tree_object.node_list if x.layer == layer][0].isLeaf()
+        padded = pad_isometry(cast(old_tensor, new_tensor.dtype), tuple(new_tensor.shape), symmetric)
+        set_layer_tensor(new_tree_object, layer, padded)
+
+
+def get_site_positions(lattice):
+    """ {site: (row, column)} of the sites of lattice """
+    return {int(site): position for position, site in np.ndenumerate(lattice)}
+
+
+def get_bonds(lattice, sub_lattice, spacings, positions=None):
+    """ docstring for get_bonds, positions from get_site_positions(lattice), computed
+        when not given """
+    if positions is None:
+        positions = get_site_positions(lattice)
+    members = set(sub_lattice.flatten().tolist())
 
     left_boundaries = {i:[] for i in spacings}
     lower_boundaries = {i:[] for i in spacings}
@@ -153,15 +526,14 @@ def get_bonds(lattice, sub_lattice, spacings):
     for space in spacings:
         linear_size = lattice.shape[0]
         for i in sub_lattice.flatten():
-            locations = np.where(lattice==i)
-            m, n = *locations[0], *locations[1]
+            m, n = positions[int(i)]
             original_location = lattice[m,n]
             # nearest-neighbour bonds
             if space != 1.5 and (space>0):
-                if (lattice[m,(n-int(space))%linear_size] not in sub_lattice):
+                if (lattice[m,(n-int(space))%linear_size] not in members):
                     left_boundaries[space].append([original_location,
                                 lattice[m,(n-int(space))%linear_size]][::-1])
-                if (lattice[(m+int(space))%linear_size, n] not in sub_lattice):
+                if (lattice[(m+int(space))%linear_size, n] not in members):
                     lower_boundaries[space].append([original_location,
                                 lattice[(m+int(space))%linear_size, n]][::-1])
 
@@ -170,10 +542,10 @@ def get_bonds(lattice, sub_lattice, spacings):
             # next-nearest-neighbour bonds
                 # single_sites.append([original_location])
             if space == 1.5:
-                if (lattice[(m-int(space))%linear_size,(n-int(space))%linear_size] not in sub_lattice):
+                if (lattice[(m-int(space))%linear_size,(n-int(space))%linear_size] not in members):
                     left_boundaries[space].append([original_location,
                                 lattice[(m-int(space))%linear_size,(n-int(space))%linear_size]][::-1])
-                if (lattice[(m+int(space))%linear_size, (n-int(space))%linear_size] not in sub_lattice):
+                if (lattice[(m+int(space))%linear_size, (n-int(space))%linear_size] not in members):
                     lower_boundaries[space].append([original_location,
                                 lattice[(m+int(space))%linear_size, (n-int(space))%linear_size]][::-1])
                 horizontal_inner_bonds[space].append([original_location,
@@ -188,36 +560,125 @@ def get_bonds(lattice, sub_lattice, spacings):
         left_boundaries)
 
 
-def get_single_network(list_of_nodes, bondtype, bond):
-    """ Docstring for get_single_network """
-    temporary_network = []
-    # if (5 in bond) and (1 in bond):
-    if len(bond) == 2:
-        for a_node in list_of_nodes:
-            for a_bond in a_node.vertical_two_site_terms[bondtype]:
-                if (a_bond[1] == bond[1]) and (a_bond[0] == bond[0]):
-                    temporary_network.append(a_node)
-            for a_bond in a_node.horizontal_two_site_terms[bondtype]:
-                if (a_bond[1] == bond[1]) and (a_bond[0] == bond[0]):
-                    temporary_network.append(a_node)
-            for a_bond in a_node.vertical_bc_terms[bondtype]:
-                if (a_bond[1] == bond[1]) and (a_bond[0] == bond[0]):
-                    temporary_network.append(a_node)
-            for a_bond in a_node.horizontal_bc_terms[bondtype]:
-                if (a_bond[1] == bond[1]) and (a_bond[0] == bond[0]):
-                    temporary_network.append(a_node)
-    if len(bond) == 1:
-        for a_node in list_of_nodes:
-            if any(a_bond[0] == bond[0] for a_bond in a_node.one_site_terms[bondtype]):
-                temporary_network.append(a_node)
-    temporary_network = list(set(temporary_network))
-    temporary_network.sort(key=lambda x: x.layer)
+def get_translations(tree_object, candidates=None):
+    """ Lattice translations under which the state is invariant. A translation has to
+        map the sites of every node onto the sites of a node in the same layer, with the
+        sites of a bottom node in the same order. It may swap the children of a node
+        only when the tensors of that layer are symmetric in their child legs. They start
+        out symmetric (create_sym_tensor) and stay so if the node optimized in the
+        layer is mapped onto itself by a translation swapping its children. The
+        operators of a bond act in the order of the bottom nodes, so unless all
+        two-site terms are symmetric under exchange the translations must keep that
+        order for every bond. Only the site maps of candidates are tried if given.
+        Returns a list of dicts with the site map 'sites', the node map 'nodes' and
+        the values of the nodes whose children are swapped, 'swaps'. """
+    lattice = tree_object.root.lattice
+    leaves = {site: (a_node.layer, a_node.value) for a_node in tree_object.node_list
+              if a_node.isLeaf() for site in a_node.lattice.flatten()}
+    order = lambda bond: [int(i) for i in sorted(bond, key=lambda site: leaves[site])]
+    bonds = [a_bond for terms in (tree_object.root.vertical_two_site_terms,
+                                  tree_object.root.horizontal_two_site_terms)
+             for bondlist in terms.values() for a_bond in bondlist]
+    exchange_symmetric = True
+    for term in fuse_hamiltonian(tree_object.hamiltonian):
+        if term[1] > 0:
+            operator = term[0][0]
+            exchange_symmetric &= float(((operator-oe.contract('abcd->badc', operator))**2).sum()) < 1e-20
+    by_sites = {(a_node.layer, frozenset(a_node.lattice.flatten().tolist())): a_node
+                for a_node in tree_object.node_list}
+    translations = []
+    for shift in np.ndindex(*lattice.shape):
+        if not any(shift):
+            continue
+        sites = np.zeros(lattice.size+1, dtype='int')
+        sites[lattice] = np.roll(lattice, [-i for i in shift], axis=(0, 1))
+        if candidates is not None and not any(np.array_equal(sites, g['sites']) for g in candidates):
+            continue
+        nodes = {}
+        for a_node in tree_object.node_list:
+            image = sites[a_node.lattice]
+            key = (a_node.layer, frozenset(image.flatten().tolist()))
+            if (key not in by_sites) or (a_node.isLeaf() and
+                                         not np.array_equal(image, by_sites[key].lattice)):
+                break
+            nodes[a_node.value] = by_sites[key].value
+        else:
+            if not exchange_symmetric and any(order(sites[a_bond]) != list(sites[order(a_bond)])
+                                              for a_bond in bonds):
+                continue
+            swaps = {a_node.value for a_node in tree_object.node_list
+                     if a_node.left and nodes[a_node.left.value] != nodes[a_node.value]+'0'}
+            translations.append({'sites': sites, 'nodes': nodes, 'swaps': swaps})
+
+    while True:
+        symmetric_layers = set()
+        for layer in range(tree_object.cut+1):
+            layer_nodes = [a_node.value for a_node in tree_object.node_list
+                           if a_node.layer == layer and a_node.left]
+            if all(any(g['nodes'][value] == value and value in g['swaps'] for g in translations)
+                   for value in layer_nodes):
+                symmetric_layers.add(layer)
+        kept = [g for g in translations if all(len(value)-1 in symmetric_layers for value in g['swaps'])]
+        if len(kept) == len(translations):
+            return translations
+        translations = kept
+
+
+def get_bond_classes(tree_object, node, bonds):
+    """ Splits bonds of node into classes of bonds that are mapped onto each other by
+        the translations fixing node, see get_translations(). Returns a representative
+        per class with its multiplicity [n, m]: the environment of node for the whole
+        class is n times the one of the representative plus m times the one with its
+        child legs swapped. """
+    stabilizer = [g for g in tree_object.translations if g['nodes'][node.value] == node.value]
+    keys = {tuple(int(i) for i in a_bond) for a_bond in bonds}
+    classes, seen = [], set()
+    for a_bond in bonds:
+        key = tuple(int(i) for i in a_bond)
+        if key in seen:
+            continue
+        seen.add(key)
+        multiplicity = [1, 0]
+        for g in stabilizer:
+            image = tuple(int(g['sites'][i]) for i in key)
+            if (image in seen) or (image not in keys):
+                continue
+            seen.add(image)
+            multiplicity[node.value in g['swaps']] += 1
+        classes.append((a_bond, multiplicity))
+    return classes
+
+
+def get_bond_index(list_of_nodes):
+    """ {(bondtype, bond): nodes holding bond in one of their lists of terms}, see
+        get_single_network() """
+    bond_index = {}
+    for a_node in list_of_nodes:
+        for terms in (a_node.vertical_two_site_terms, a_node.horizontal_two_site_terms,
+                      a_node.vertical_bc_terms, a_node.horizontal_bc_terms, a_node.one_site_terms):
+            for bondtype, bonds in terms.items():
+                for a_bond in bonds:
+                    nodes = bond_index.setdefault((float(bondtype), tuple(int(i) for i in a_bond)), [])
+                    if not nodes or nodes[-1] is not a_node:
+                        nodes.append(a_node)
+    return bond_index
+
+
+def get_single_network(list_of_nodes, bondtype, bond, bond_index=None):
+    """ Docstring for get_single_network, bond_index from get_bond_index(list_of_nodes),
+        built when not given """
+    if bond_index is None:
+        bond_index = get_bond_index(list_of_nodes)
+    temporary_network = list(set(bond_index.get((float(bondtype), tuple(int(i) for i in bond)), [])))
+    # sort on value as well so equal bonds get equal leg labels for every node
+    temporary_network.sort(key=lambda x: (x.layer, x.value))
 
     return {'bond':  bond, 'bondspace': bondtype, 'temporary_network': temporary_network}
 
 
-def get_legs(cut, node, network):
-    """ Docstring for get_legs() """
+def get_legs(cut, node, network, fuse_operators=False):
+    """ Docstring for get_legs(), with fuse_operators the two operators of a two-site
+        term are a single operator with legs [bra, bra, ket, ket], see fuse_hamiltonian() """
 
     for current_network in network:
         bond = current_network['bond']
@@ -307,6 +768,9 @@ def get_legs(cut, node, network):
 
         # if reverse_bool:
         #     operator_legs = operator_legs[::-1]
+        if fuse_operators and len(operator_legs) == 2:
+            operator_legs = [np.concatenate((operator_legs[0][:1], operator_legs[1][:1],
+                                             operator_legs[0][1:], operator_legs[1][1:]))]
         all_legs.extend(operator_legs[:])
         copy_shape = []
         current_network['full_legs'] = all_legs
@@ -351,7 +815,7 @@ def get_legs(cut, node, network):
         current_network['environment_legs'] = new_environment_legs
 
 
-def get_optimal_order(node, dict_of_networks, optimize_type):
+def get_optimal_order(node, dict_of_networks, optimize_type, memory_limit=None, path_cache=None):
     """ Docstring for get_optimal_orders() """
     copied_environment_legs = [np.copy(l) for l in
                                dict_of_networks['environment_legs']]
@@ -366,189 +830,934 @@ def get_optimal_order(node, dict_of_networks, optimize_type):
     for legs in copied_environment_legs:
         legs += np.abs(np.min(k))
 
-    if len(dict_of_networks['bond']) == 2:
-        for m,n in zip(dict_of_networks['environment'],
-                       copied_environment_legs[:-2]):
-            new_path.append(m.current_tensor)
-            new_path.append(n)
-        new_path.append(np.eye(2))
-        new_path.append(copied_environment_legs[-2])
-        new_path.append(np.eye(2))
-        new_path.append(copied_environment_legs[-1])
-
-    elif len(dict_of_networks['bond']) == 1:
-        for m,n in zip(dict_of_networks['environment'],
-                       copied_environment_legs[:-1]):
-            new_path.append(m.current_tensor)
-            new_path.append(n)
-        new_path.append(np.eye(2))
-        new_path.append(copied_environment_legs[-1])
-
-    new_opt_path = oe.contract_path(*new_path, out, optimize=optimize_type)
-    # print(copied_energy_legs)
-
-    if len(dict_of_networks['bond']) == 2:
-        for m,n in zip(dict_of_networks['entire_network'], copied_energy_legs[:-2]):
-            new_path_energy.append(m.current_tensor)
-            new_path_energy.append(n)
-        # print(copied_energy_legs[:-2])
-        # print([k.value for k in dict_of_networks['entire_network']])
-        new_path_energy.append(np.eye(2))
-        new_path_energy.append(copied_energy_legs[-2])
-        new_path_energy.append(np.eye(2))
-        new_path_energy.append(copied_energy_legs[-1])
-    elif len(dict_of_networks['bond']) == 1:
-        for m,n in zip(dict_of_networks['entire_network'], copied_energy_legs[:-1]):
-            new_path_energy.append(m.current_tensor)
-            new_path_energy.append(n)
-
-        new_path_energy.append(np.eye(2))
-        new_path_energy.append(copied_energy_legs[-1])
-
-    new_opt_path_energy = oe.contract_path(*new_path_energy,optimize=optimize_type)
+    # placeholders for the operators, a fused two-site operator has four legs
+    n_operators = len(dict_of_networks['full_legs'])-len(dict_of_networks['entire_network'])
+    for m,n in zip(dict_of_networks['environment'],
+                   copied_environment_legs[:-n_operators]):
+        new_path.append(m.current_tensor)
+        new_path.append(n)
+    for n in copied_environment_legs[-n_operators:]:
+        new_path.append(np.empty([2]*len(n)))
+        new_path.append(n)
+
+    shapes = [x.shape for x in new_path[::2]]
+    path, flops, largest_intermediate = get_path(get_equation(copied_environment_legs, out), shapes,
+                                                 optimize_type, path_cache=path_cache)
+
+    for m,n in zip(dict_of_networks['entire_network'], copied_energy_legs[:-n_operators]):
+        new_path_energy.append(m.current_tensor)
+        new_path_energy.append(n)
+    for n in copied_energy_legs[-n_operators:]:
+        new_path_energy.append(np.empty([2]*len(n)))
+        new_path_energy.append(n)
+
+    energy_shapes = [x.shape for x in new_path_energy[::2]]
+    energy_path, energy_flops, energy_largest_intermediate = get_path(
+        get_equation(copied_energy_legs, []), energy_shapes, optimize_type, path_cache=path_cache)
     # add new keys to existing dictionary
-    dict_of_networks['einsum_path'] = new_opt_path[0]
+    dict_of_networks['einsum_path'] = path
     dict_of_networks['einsum_indices'] = copied_environment_legs
     dict_of_networks['out_list'] = out
     dict_of_networks['tensor_list'] = list_of_tensors
     dict_of_networks['einsum_energy_indices'] = copied_energy_legs
-    dict_of_networks['einsum_path_energy'] = new_opt_path_energy[0]
+    dict_of_networks['einsum_path_energy'] = energy_path
+    # flops and largest intermediate (elements) of the environment and the energy
+    dict_of_networks['cost'] = {'flops': flops, 'largest_intermediate': largest_intermediate,
+                                'energy_flops': energy_flops,
+                                'energy_largest_intermediate': energy_largest_intermediate}
+    # compiled once, contract_network() only has to feed the tensors
+    # with a memory limit the paths are planned again, within the limit
+    dict_of_networks['expression'] = get_expression(
+        copied_environment_legs, out, shapes,
+        path if memory_limit is None else optimize_type, memory_limit, path_cache)
+    dict_of_networks['expression_energy'] = get_expression(
+        copied_energy_legs, [], energy_shapes,
+        energy_path if memory_limit is None else optimize_type, memory_limit, path_cache)
 
 
 def contract_network(operators, network, contract_type='env'):
-    temp_operators = [i for i in operators[0]]
-    path = []
     if contract_type == 'env':
-        for m,n in zip(network['environment'], network['einsum_indices']):
-            path.append(m.current_tensor)
-            path.append(n)
-        for m,n in zip(temp_operators, network['einsum_indices'][-len(temp_operators):]):
-            path.append(m)
-            path.append(n)
-
-        return oe.contract(*path, network['out_list'],
-                    optimize=network['einsum_path'])
+        tensors = [m.current_tensor for m in network['environment']]
+        tensors = tensors[:len(network['einsum_indices'])-len(operators[0])]
+        return network['expression'](*tensors, *operators[0])
 
     elif contract_type == 'energy':
-        for m,n in zip(network['entire_network'], network['einsum_energy_indices']):
-            path.append(m.current_tensor)
-            # print(m.current_tensor)
-            path.append(n)
-
-        for m,n in zip(temp_operators, network['einsum_energy_indices'][-len(temp_operators):]):
-            path.append(m)
-            path.append(n)
-            # to_contract = [*[m.cur_tensor, n] in zip(network['entire_network'], network['full_legs'])]
-        # print(oe.contract(*path, optimize=network['einsum_path_energy']))
-        return oe.contract(*path, optimize=network['einsum_path_energy'])
+        tensors = [m.current_tensor for m in network['entire_network']]
+        tensors = tensors[:len(network['einsum_energy_indices'])-len(operators[0])]
+        return network['expression_energy'](*tensors, *operators[0])
+
+
+def get_equation(legs, out):
+    """ einsum equation of tensors with the given index lists, symbols are assigned in
+        order of appearance so equal leg structures give equal equations """
+    symbols = {}
+    subscripts = [''.join(symbols.setdefault(int(i), oe.get_symbol(len(symbols))) for i in a_legs)
+                  for a_legs in legs]
+    return ','.join(subscripts)+'->'+''.join(symbols[int(i)] for i in out)
+
+
+def open_path_cache(file_name, max_size=64*2**20):
+    """ Persistent cache of contraction paths, a sqlite database in file_name that
+        holds at most max_size bytes of paths, least recently used ones are evicted.
+        Every new path is committed on its own, so concurrent runs only ever wait for
+        a single write. See get_path() and close_path_cache() """
+    folder = os.path.dirname(os.path.abspath(file_name))
+    os.makedirs(folder, exist_ok=True)
+    # autocommit, no transaction is left open between statements
+    connection = sqlite3.connect(file_name, timeout=600, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS paths '
+                       '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)')
+    return {'connection': connection, 'max_size': max_size, 'used': {}, 'hits': 0, 'misses': 0}
+
+
+def close_path_cache(path_cache):
+    """ stores the last-used times of the paths taken from the cache since
+        open_path_cache() and evicts the least recently used paths beyond its
+        max_size, in one short transaction """
+    connection = path_cache['connection']
+    connection.execute('BEGIN IMMEDIATE')
+    connection.executemany('UPDATE paths SET used=? WHERE key=?',
+                           [(used, key) for key, used in path_cache['used'].items()])
+    size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM paths').fetchone()[0]
+    if size > path_cache['max_size']:
+        used = 0
+        for key, size in connection.execute('SELECT key, size FROM paths ORDER BY used DESC').fetchall():
+            used += size
+            if used > path_cache['max_size']:
+                connection.execute('DELETE FROM paths WHERE key=?', (key,))
+    connection.execute('COMMIT')
+    connection.close()
+
+
+def get_path(equation, shapes, optimize, memory_limit=None, path_cache=None):
+    """ (path, flops, largest intermediate) of the contraction equation of tensors
+        with the given shapes. Taken from path_cache, see open_path_cache(), when
+        optimize is the name of an opt_einsum optimizer; the key is the equation,
+        shapes, optimizer, memory limit and opt_einsum version """
+    if path_cache is not None and isinstance(optimize, str):
+        key = hashlib.sha1(json.dumps([equation, [[int(d) for d in shape] for shape in shapes], optimize,
+                                       memory_limit, oe.__version__]).encode()).hexdigest()
+        connection = path_cache['connection']
+        row = connection.execute('SELECT value FROM paths WHERE key=?', (key,)).fetchone()
+        if row is not None:
+            path_cache['hits'] += 1
+            path_cache['used'][key] = time.time()
+            path, flops, largest_intermediate = json.loads(row[0])
+            return [tuple(i) for i in path], flops, largest_intermediate
+        path_cache['misses'] += 1
+    path, info = oe.contract_path(equation, *shapes, shapes=True, optimize=optimize,
+                                  memory_limit=memory_limit)
+    path = [tuple(int(j) for j in i) for i in path]
+    result = (path, int(info.opt_cost), int(info.largest_intermediate))
+    if path_cache is not None and isinstance(optimize, str):
+        value = json.dumps(result)
+        connection.execute('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)',
+                           (key, value, len(value), time.time()))
+    return result
+
+
+def get_expression(legs, out, shapes, optimize, memory_limit=None, path_cache=None):
+    """ compiled opt_einsum contraction of tensors with the given index lists and
+        shapes, optimize is either an optimize_type or a precomputed path. With
+        memory_limit, the largest number of elements an intermediate may have, a
+        contraction that does not fit is sliced, see get_slices(). Paths are looked
+        up in path_cache when given, see get_path() """
+    equation = get_equation(legs, out)
+    subscripts, output = equation.split('->')
+    subscripts = subscripts.split(',')
+    if memory_limit is None:
+        if isinstance(optimize, str):
+            optimize = get_path(equation, shapes, optimize, path_cache=path_cache)[0]
+        return oe.contract_expression(equation, *shapes, optimize=optimize)
+    sliced, path = get_slices(subscripts, output, shapes, optimize, memory_limit, path_cache)
+    sliced_subscripts = [''.join(c for c in a_subscript if c not in sliced) for a_subscript in subscripts]
+    sliced_shapes = [[d for c, d in zip(a_subscript, shape) if c not in sliced]
+                     for a_subscript, shape in zip(subscripts, shapes)]
+    expression = oe.contract_expression(','.join(sliced_subscripts)+'->'+output, *sliced_shapes,
+                                        optimize=path)
+    if not sliced:
+        return expression
+    slices = [(dict(zip(''.join(subscripts), it.chain(*shapes)))[c],
+               [a_subscript.index(c) if c in a_subscript else None for a_subscript in subscripts])
+              for c in sliced]
+    return functools.partial(contract_sliced, expression, slices)
+
+
+def get_slices(subscripts, output, shapes, optimize, memory_limit, path_cache=None):
+    """ (summed indices to slice, path of the sliced contraction) such that no
+        intermediate has more than memory_limit elements. A path planned within
+        memory_limit is used if it is not more expensive than slicing: indices are
+        sliced greedily, each time the one that shrinks the largest intermediate most,
+        paying the contraction cost once per value of the sliced indices """
+    dims = dict(zip(''.join(subscripts), it.chain(*shapes)))
+
+    def plan(sliced, limit=None):
+        """ (largest intermediate, cost, sliced, path) """
+        path, flops, largest_intermediate = get_path(
+            ','.join(''.join(c for c in a_subscript if c not in sliced) for a_subscript in subscripts)+'->'+output,
+            [[d for c, d in zip(a_subscript, shape) if c not in sliced]
+             for a_subscript, shape in zip(subscripts, shapes)], optimize, limit, path_cache)
+        return (largest_intermediate, flops*int(np.prod([dims[c] for c in sliced])), sliced, path)
+
+    best = plan(())
+    if best[0] <= memory_limit:
+        return best[2], best[3]
+    limited = plan((), memory_limit)
+    candidates = [c for c in dims if c not in output and dims[c] > 1]
+    while best[0] > memory_limit and candidates:
+        option = min((plan(best[2]+(c,)) for c in candidates), key=lambda x: x[:2])
+        if option[0] >= best[0]:
+            # the largest intermediate is the output, or equally big
+            break
+        best = option
+        candidates.remove(best[2][-1])
+    if limited[0] <= memory_limit and (best[0] > memory_limit or limited[1] <= best[1]):
+        best = limited
+    elif best[0] > memory_limit:
+        print('contraction needs %s elements, more than the memory limit of %s'%(best[0], memory_limit))
+    return best[2], best[3]
+
+
+def contract_sliced(expression, slices, *tensors):
+    """ sum of expression over all values of the sliced indices, accumulated in place.
+        slices has per sliced index its dimension and its axis in every tensor (None
+        when the tensor does not carry it) """
+    result = None
+    for values in it.product(*[range(dim) for dim, axes in slices]):
+        sliced_tensors = []
+        for t, tensor in enumerate(tensors):
+            index = [slice(None)]*tensor.ndim
+            for value, (dim, axes) in zip(values, slices):
+                if axes[t] is not None:
+                    index[axes[t]] = value
+            sliced_tensors.append(tensor[tuple(index)])
+        partial = expression(*sliced_tensors)
+        if result is None:
+            result = partial+0 # a copy, partial can be a view of an input
+        else:
+            result += partial
+    return result
+
+
+def get_plan_expression(legs, out, dims, optimize_type, memory_limit=None, path_cache=None):
+    """ get_expression() for a list of index lists with dimensions dims """
+    return get_expression(legs, out, [[dims[i] for i in a_legs] for a_legs in legs], optimize_type,
+                          memory_limit, path_cache)
+
+
+def get_leaf_axes(network):
+    """ for every bottom node of network the axes its operators act on, in the
+        order of the operators """
+    all_legs = network['full_legs']
+    operator_legs = all_legs[len(network['entire_network']):]
+    leaf_axes = {}
+    for a_node, bralegs in zip(network['entire_network'][::2], all_legs[::2]):
+        if a_node.isLeaf():
+            bralegs = list(bralegs)
+            leaf_axes[a_node.value] = [bralegs.index(i) for legs in operator_legs
+                                       for i in legs if i in bralegs[1:]]
+    return leaf_axes
+
+
+def get_permutation(target, source, n_axes):
+    """ axes that move the source axes of a bottom tensor onto the target axes,
+        the other (physical) axes keep their order """
+    axes = [0]*n_axes
+    for t, s in zip(target, source):
+        axes[t] = s
+    rest_source = [i for i in range(1, n_axes) if i not in source]
+    rest_target = [i for i in range(1, n_axes) if i not in target]
+    for t, s in zip(rest_target, rest_source):
+        axes[t] = s
+    return axes
+
+
+def get_canonical_legs(all_legs):
+    """ leg labels renumbered in order of appearance, equal for networks that only
+        differ by the naming of their legs """
+    labels = {}
+    return [[labels.setdefault(int(i), len(labels)) for i in legs] for legs in all_legs]
+
+
+def get_network_groups(networks, batch_size=None):
+    """ Groups networks with the same contraction topology: the same nodes and leg
+        structure, differing only in which physical legs of the bottom tensors the
+        operators act on. Permuting those bottom tensors maps every member onto the
+        first network of the group, so a group is contracted as a single network
+        with the permuted bottom tensors stacked along an extra batch leg.
+        Groups hold at most batch_size networks. """
+    groups = []
+    for network in sorted(networks, key=lambda x: [int(i) for i in x['bond']]):
+        leaf_axes = get_leaf_axes(network)
+        signature = (float(network['bondspace']), tuple(x.value for x in network['unique_tensors']),
+                     tuple((value, len(axes)) for value, axes in leaf_axes.items()),
+                     tuple(network['multiplicity']))
+        for group in groups:
+            if group['signature'] != signature or len(group['networks']) == batch_size:
+                continue
+            representative = group['networks'][0]
+            permutations = {}
+            permuted_legs = [list(legs) for legs in network['full_legs']]
+            for i, a_node in enumerate(network['entire_network']):
+                if a_node.value in leaf_axes:
+                    axes = get_permutation(group['leaf_axes'][a_node.value], leaf_axes[a_node.value],
+                                           len(permuted_legs[i]))
+                    permutations[a_node.value] = axes
+                    permuted_legs[i] = [permuted_legs[i][a] for a in axes]
+            if get_canonical_legs(permuted_legs) == get_canonical_legs(representative['full_legs']):
+                group['networks'].append(network)
+                group['member_axes'].append(permutations)
+                break
+        else:
+            groups.append({'signature': signature, 'networks': [network], 'leaf_axes': leaf_axes,
+                           'member_axes': [{value: list(range(len(network['full_legs'][2*i])))
+                                            for i, value in enumerate(signature[1]) if value in leaf_axes}],
+                           'bondspace': network['bondspace'], 'multiplicity': network['multiplicity'],
+                           'kind': network['kind']})
+
+    for group in groups:
+        group['cache_key'] = (group['signature'][0],
+                              tuple(tuple(int(i) for i in x['bond']) for x in group['networks']))
+        # bottom tensors whose operators do not sit on the same legs for all members
+        group['permutations'] = {}
+        for value in group['leaf_axes']:
+            axes = [member[value] for member in group['member_axes']]
+            if any(a != axes[0] for a in axes):
+                group['permutations'][value] = axes
+    return groups
+
+
+def get_environment_plan(node, group, optimize_type, memory_limit=None, path_cache=None):
+    """ Splits the environment of node for a group of networks into blocks. Every
+        sub-tree hanging below the path from the root to node is contracted (bra, ket
+        and the operators acting on it) into a block, which only depends on the layers
+        inside that sub-tree and can therefore be cached, see contract_block().
+
+        A bottom tensor whose operators move around within the group is either
+        replaced by the sum over the group of the operators applied to its ket
+        ('applied', when it is the only such tensor) or stacked along the batch leg
+        ('stacked'), the batch leg is summed as soon as no other tensor carries it. """
+    network = group['networks'][0]
+    tensors = network['entire_network']
+    nodes = network['unique_tensors']
+    all_legs = [[int(i) for i in legs] for legs in network['full_legs']]
+    operator_legs = all_legs[len(tensors):]
+    bra_position = {a_node.value: 2*i for i, a_node in enumerate(nodes)}
+
+    dims = {}
+    for a_tensor, legs in zip(tensors, all_legs):
+        dims.update(zip(legs, a_tensor.current_tensor.shape))
+    batch_leg = max(dims)+1
+    dims[batch_leg] = len(group['networks'])
+
+    # an operator belongs to the lowest node whose sub-tree holds all its sites
+    owners = []
+    for legs in operator_legs:
+        touching = [a_node.value for a_node, tensor_legs in zip(tensors, all_legs)
+                    if set(legs) & set(tensor_legs)]
+        owners.append(os.path.commonprefix(touching))
+
+    applied = None
+    if len(group['permutations']) == 1:
+        value = list(group['permutations'])[0]
+        touching = [owner for owner, legs in zip(owners, operator_legs)
+                    if set(legs) & set(all_legs[bra_position[value]])]
+        if all(owner == value for owner in touching):
+            applied = value
+
+    entries = []
+    for i, (a_tensor, legs) in enumerate(zip(tensors, all_legs)):
+        if a_tensor.value == applied and i%2:
+            entries.append((('applied', a_tensor.value), a_tensor.value,
+                            [legs[0]]+all_legs[i-1][1:]))
+        elif a_tensor.value == applied:
+            entries.append((('tensor', i), a_tensor.value, legs))
+        elif a_tensor.value in group['permutations']:
+            entries.append((('stacked', i), a_tensor.value, [batch_leg]+legs))
+        else:
+            entries.append((('tensor', i), a_tensor.value, legs))
+    for k, (owner, legs) in enumerate(zip(owners, operator_legs)):
+        if owner != applied:
+            entries.append((('operator', k), owner, legs))
+
+    path_values = [a_node.value for a_node in nodes if node.value.startswith(a_node.value)]
+    block_plans = {}
+    for a_node in sorted(nodes, key=lambda x: x.layer, reverse=True):
+        if a_node.value in path_values:
+            continue
+        inputs = [entry for entry, value, legs in entries if value == a_node.value]
+        legs = [legs for entry, value, legs in entries if value == a_node.value]
+        for child in nodes:
+            if child.parent is a_node:
+                inputs.append(('block', child.value))
+                legs.append(block_plans[child.value]['out'])
+
+        inside, outside = set(), set()
+        for entry, value, entry_legs in entries:
+            (inside if value.startswith(a_node.value) else outside).update(entry_legs)
+        out = []
+        for i in [m for n in legs for m in n]:
+            if i in inside and i in outside and i not in out:
+                out.append(i)
+
+        block_plans[a_node.value] = {'layer': a_node.layer, 'inputs': inputs, 'legs': legs,
+                                     'out': out, 'expression': get_plan_expression(legs, out, dims, optimize_type, memory_limit, path_cache)}
+
+        # summing the small blocks of the members beats applying their operators to the ket
+        if a_node.value == applied:
+            i = bra_position[applied]
+            operators = [k for k, owner in enumerate(owners) if owner == applied]
+            inputs = [('tensor', i), ('tensor', i+1)]+[('operator', k) for k in operators]
+            members = []
+            for a_network in group['networks']:
+                a_legs = [[int(j) for j in l] for l in a_network['full_legs']]
+                members.append(get_plan_expression(
+                    [a_legs[i], a_legs[i+1]]+[a_legs[len(tensors)+k] for k in operators],
+                    [a_legs[i][0], a_legs[i+1][0]], dims, optimize_type, memory_limit, path_cache))
+            block_plans[applied] = {'layer': a_node.layer, 'inputs': inputs,
+                                    'out': [all_legs[i][0], all_legs[i+1][0]], 'members': members}
+
+    inputs, legs = [], []
+    for i, (entry, value, entry_legs) in enumerate(entries):
+        if value in path_values and i != bra_position[node.value]:
+            inputs.append(entry)
+            legs.append(entry_legs)
+    for a_node in nodes:
+        if a_node.value not in path_values and a_node.parent.value in path_values:
+            inputs.append(('block', a_node.value))
+            legs.append(block_plans[a_node.value]['out'])
+    out = all_legs[bra_position[node.value]]
+    unpermute = None
+    if node.value in group['permutations'] and node.value != applied:
+        out = [batch_leg]+out
+        unpermute = [list(np.argsort(axes)) for axes in group['permutations'][node.value]]
+
+    # per member the contraction applying its operators to the ket of the 'applied' tensor
+    applied_plans = []
+    if applied is not None:
+        operators = [k for k, owner in enumerate(owners) if owner == applied]
+        i = bra_position[applied]
+        for a_network in group['networks']:
+            a_legs = [[int(j) for j in l] for l in a_network['full_legs']]
+            applied_plans.append(get_plan_expression(
+                [a_legs[i+1]]+[a_legs[len(tensors)+k] for k in operators],
+                [a_legs[i+1][0]]+a_legs[i][1:], dims, optimize_type, memory_limit, path_cache))
+        group['applied_operators'] = operators
+
+    group['block_plans'] = block_plans
+    group['applied_plans'] = applied_plans
+    group['environment_plan'] = {'layer': node.layer, 'inputs': inputs, 'legs': legs, 'out': out,
+                                 'unpermute': unpermute,
+                                 'expression': get_plan_expression(legs, out, dims, optimize_type, memory_limit, path_cache)}
+
+
+def get_stacked_tensor(group, index):
+    """ bottom tensor at position index of the first network, permuted for every
+        member of group and stacked along the batch leg """
+    a_node = group['networks'][0]['entire_network'][index]
+    tensor = a_node.current_tensor
+    if isinstance(tensor, np.ndarray):
+        return np.stack([tensor.transpose(axes) for axes in group['permutations'][a_node.value]])
+    return torch.stack([tensor.permute(*axes) for axes in group['permutations'][a_node.value]])
+
+
+def get_applied_tensor(operators, group, value):
+    """ sum over the members of group of their operators applied to the ket of the
+        bottom tensor 'value' """
+    tensor = [x for x in group['networks'][0]['unique_tensors'] if x.value == value][0].current_tensor
+    applied_operators = [operators[0][k] for k in group['applied_operators']]
+    applied = 0
+    for expression in group['applied_plans']:
+        applied = applied + expression(tensor, *applied_operators)
+    return applied
+
+
+def contract_plan(tree_object, operators, group, term, plan):
+    """ contracts a block or environment plan made by get_environment_plan(), plans
+        with 'members' are contracted for every member of group and summed """
+    tensors, stacked = [], {}
+    for kind, index in plan['inputs']:
+        if kind == 'tensor':
+            tensors.append(group['networks'][0]['entire_network'][index].current_tensor)
+        elif kind == 'stacked':
+            value = group['networks'][0]['entire_network'][index].value
+            if value not in stacked:
+                stacked[value] = get_stacked_tensor(group, index)
+            tensors.append(stacked[value])
+        elif kind == 'applied':
+            tensors.append(get_applied_tensor(operators, group, index))
+        elif kind == 'block':
+            tensors.append(contract_block(tree_object, operators, group, term, index))
+        else:
+            tensors.append(operators[0][index])
+
+    if 'members' not in plan:
+        return plan['expression'](*tensors)
+    result = 0
+    for expression in plan['members']:
+        result = result + expression(*tensors)
+    return result
+
+
+def contract_block(tree_object, operators, group, term, value):
+    """ returns the block of the sub-tree below node 'value', taken from
+        tree_object.environment_cache if none of its layers changed since """
+    plan = group['block_plans'][value]
+    if not tree_object.cache_environments:
+        return contract_plan(tree_object, operators, group, term, plan)
+    cache = tree_object.environment_cache[plan['layer']]
+    key = (term, *group['cache_key'], value)
+    if key not in cache:
+        cache[key] = contract_plan(tree_object, operators, group, term, plan)
+    return cache[key]
+
+
+def contract_environment(tree_object, operators, network, term):
+    """ Environment of the node owning network for hamiltonian term number 'term',
+        same result as contract_network(operators, network) weighted by the
+        multiplicity of network. With grouped networks network is a group from
+        get_network_groups() and the environments of its members are summed """
+    if not tree_object.group_networks:
+        environment = contract_network(operators, network)
+    else:
+        plan = network['environment_plan']
+        environment = contract_plan(tree_object, operators, network, term, plan)
+        if plan['unpermute'] is not None:
+            environment = sum(environment[i].transpose(axes) if isinstance(environment, np.ndarray)
+                              else environment[i].permute(*axes)
+                              for i, axes in enumerate(plan['unpermute']))
+    return apply_multiplicity(environment, network['multiplicity'])
+
+
+def apply_multiplicity(environment, multiplicity):
+    """ environment of a whole class of translation equivalent networks from the
+        environment of its representative, see get_bond_classes() """
+    unswapped, swapped = multiplicity
+    if swapped == 0:
+        return environment if unswapped == 1 else environment*unswapped
+    if isinstance(environment, np.ndarray):
+        return environment*unswapped + environment.transpose(0, 2, 1)*swapped
+    return environment*unswapped + environment.permute(0, 2, 1)*swapped
+
+
+def contract_energy(tree_object, operators, network, term, node):
+    """ Energy of network times its multiplicity, for a group of networks this is the
+        environment of node contracted with its tensor """
+    if not tree_object.group_networks:
+        return contract_network(operators, network, contract_type='energy')*sum(network['multiplicity'])
+    return (node.current_tensor*contract_environment(tree_object, operators, network, term)).sum()
+
+
+def clear_environment_cache(tree_object, layer=None):
+    """ Removes the cached blocks that depend on layer, a block depends on the layer
+        of its top node and all layers below. Clears everything if layer is None """
+    for block_layer, cache in tree_object.environment_cache.items():
+        if (layer is None) or (block_layer <= layer):
+            cache.clear()
+
+
+def fuse_hamiltonian(hamiltonian):
+    """ Sums the terms of hamiltonian that share a spacing into a single term with the
+        vertical and horizontal coefficients folded in. Two-site operators become one
+        operator O[bra0, bra1, ket0, ket1], to be used with networks built by
+        get_legs(..., fuse_operators=True). Directions with different operators get a
+        term each, with the other coefficient set to zero. """
+    fused = []
+    for spacing in np.unique([i[1] for i in hamiltonian]):
+        terms = [i for i in hamiltonian if np.allclose(i[1], spacing)]
+        if spacing == 0:
+            operator = sum(i[0][0]*i[-1][0] for i in terms)
+            fused.append([[operator], spacing, [1.]])
+            continue
+        products = [oe.contract('ac,bd->abcd', *i[0]) for i in terms]
+        vertical = sum(a_product*i[-1][0] for a_product, i in zip(products, terms))
+        if all(i[-1][0] == i[-1][1] for i in terms):
+            fused.append([[vertical], spacing, [1., 1.]])
+        else:
+            horizontal = sum(a_product*i[-1][1] for a_product, i in zip(products, terms))
+            fused.append([[vertical], spacing, [1., 0.]])
+            fused.append([[horizontal], spacing, [0., 1.]])
+    return fused
+
+
+def get_networks(tree_object, node, kind, coefficient=1.):
+    """ networks of node of the given kind ('vertical', 'horizontal' or 'one_site'),
+        grouped by get_network_groups() when environments are cached or networks
+        batched. None for a term with a vanishing coefficient in that direction """
+    if coefficient == 0:
+        return []
+    if tree_object.group_networks:
+        return getattr(node, kind+'_groups')
+    return getattr(node, kind+'_networks')
+
+
+def get_cost(tree_object, node):
+    """ {kind: cost} of the environment and energy of node, summed over the networks
+        that are contracted for the hamiltonian, the largest intermediates are the
+        maximum over them. See get_optimal_order() """
+    costs = {}
+    for operators in tree_object.fused_hamiltonian:
+        if operators[1] > 0:
+            directions = [('vertical', operators[-1][0]), ('horizontal', operators[-1][1])]
+        else:
+            directions = [('one_site', operators[-1][0])]
+        for kind, coefficient in directions:
+            cost = costs.setdefault(kind, {'networks': 0, 'flops': 0, 'largest_intermediate': 0,
+                                           'energy_flops': 0, 'energy_largest_intermediate': 0})
+            if coefficient == 0:
+                continue
+            for network in getattr(node, kind+'_networks'):
+                if np.allclose(operators[1], network['bondspace']):
+                    cost['networks'] += 1
+                    for key in ('flops', 'energy_flops'):
+                        cost[key] += network['cost'][key]
+                    for key in ('largest_intermediate', 'energy_largest_intermediate'):
+                        cost[key] = max(cost[key], network['cost'][key])
+    return costs
+
+
+def get_terms(tree_object, node):
+    """ (term, operators, network, coefficient) for every network of node that has to
+        be contracted, in a fixed order """
+    terms = []
+    for term, operators in enumerate(tree_object.fused_hamiltonian):
+        if operators[1] > 0:
+            directions = [('vertical', operators[-1][0]), ('horizontal', operators[-1][1])]
+        else:
+            directions = [('one_site', operators[-1][0])]
+        for kind, coefficient in directions:
+            for network in get_networks(tree_object, node, kind, coefficient):
+                if np.allclose(operators[1], network['bondspace']):
+                    terms.append((term, operators, network, coefficient))
+    return terms
+
+
+def map_tasks(tree_object, function, tasks):
+    """ function(*task) for all tasks, on tree_object.threads threads when set. Results
+        are yielded in the order of tasks as soon as they are done, so reducing them is
+        deterministic. BLAS runs on tree_object.blas_threads threads per task until
+        the last task is done, through threadpoolctl (numpy) and torch. Both limits
+        are process-wide, they are lifted before the remaining results are yielded """
+    if not tree_object.threads or tree_object.threads == 1:
+        for task in tasks:
+            yield function(*task)
+        return
+    if tree_object.executor is None:
+        tree_object.executor = ThreadPoolExecutor(tree_object.threads)
+    blas_threads = tree_object.blas_threads or max(1, (os.cpu_count() or 1)//tree_object.threads)
+    torch_threads = torch.get_num_threads()
+    torch.set_num_threads(blas_threads)
+    limits = threadpool_limits(blas_threads) if threadpool_limits else None
+
+    def restore():
+        torch.set_num_threads(torch_threads)
+        if limits is not None:
+            limits.restore_original_limits()
+
+    futures = [tree_object.executor.submit(function, *task) for task in tasks]
+    limited = True
+    try:
+        for i, future in enumerate(futures):
+            result = future.result()
+            if limited and all(a_future.done() for a_future in futures[i+1:]):
+                limited = False
+                restore()
+            yield result
+    finally:
+        for future in futures:
+            future.cancel()
+        if limited:
+            restore()
+
+
+def map_terms(tree_object, function, terms):
+    """ function(term, operators, network) for all terms, see map_tasks() """
+    return list(map_tasks(tree_object, function, [x[:3] for x in terms]))
 
 
 def get_energy(tree_object, node):
     """ Docstring for get_energy() """
+    with phase(tree_object, 'energy', full=True):
+        if tree_object.workers:
+            for connection in tree_object.workers:
+                connection.send(('energy', node.value))
+            return sum(connection.recv() for connection in tree_object.workers)
+        return get_partial_energy(tree_object, node, get_terms(tree_object, node))
+
+
+def get_partial_energy(tree_object, node, terms):
+    """ energy of the given terms of node, see get_terms() """
+    energies = map_terms(tree_object, lambda term, operators, network:
+                         contract_energy(tree_object, operators, network, term, node), terms)
     temp = 0
-    if tree_object.backend == 'torch':
-        for operators in tree_object.hamiltonian:
-            if operators[1] > 0:
-                for network in node.vertical_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-                        temp += (contract_network(operators, network,
-                                contract_type='energy')*operators[-1][0]).item()
-                for network in node.horizontal_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-
-
-                        temp += (contract_network(operators, network,
-                                contract_type='energy')*operators[-1][1]).item()
-
-            else:
-                for network in node.one_site_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-
-                        temp += (contract_network(operators, network,
-                                contract_type='energy')*operators[-1][0]).item()
-
-    elif tree_object.backend == 'numpy':
-        for operators in tree_object.hamiltonian:
-
-            if operators[1] > 0:
-                for network in node.vertical_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-                        # print('ver ',contract_network(operators, network,
-                        # contract_type='energy').size())
-                        temp += contract_network(operators, network,
-                                contract_type='energy')*operators[-1][0]
-
-                for network in node.horizontal_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-
-                        # print('hor ',contract_network(operators, network,
-                        # contract_type='energy').size())
-                        temp += contract_network(operators, network,
-                                contract_type='energy')*operators[-1][1]
-            else:
-                for network in node.one_site_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-
-                        # print('one', contract_network(operators, network,
-                        # contract_type='energy').size())
-                        temp += contract_network(operators, network,
-                                contract_type='energy')*operators[-1][0]
-
+    for energy, (term, operators, network, coefficient) in zip(energies, terms):
+        temp += float(energy)*coefficient
     return temp
 
-@timer
-def optimize_tensor(tree_object, node):
-    """ VOID: optimize method for a single tensor in the Tree Tensor Network using optimal einsum"""
-
-    if tree_object.backend == 'torch':
-        node.cache_tensor.zero_()
-        for operators in tree_object.hamiltonian:
-            for network in node.vertical_networks:
-                if np.allclose(operators[1], network['bondspace']):
-                    node.cache_tensor.add_(contract_network(operators, network)*operators[-1][0])
-            for network in node.horizontal_networks:
-                if np.allclose(operators[1], network['bondspace']):
-                    node.cache_tensor.add_(contract_network(operators, network)*operators[-1][1])
-
-            for network in node.one_site_networks:
-                if np.allclose(operators[1], network['bondspace']):
-                    node.cache_tensor.add_(contract_network(operators, network)*operators[-1][0])
-
-        new_shapes = node.cache_tensor.shape
-        # need to transpose since torch saves n x n matrix of u, n being the first axes
-        ut, s, v = node.cache_tensor.reshape(new_shapes[0], np.prod(new_shapes[1:])).T.svd(some=True)
-        # torch returns u transposed hence ut.T
-        node.current_tensor = -1.*torch.matmul(v,ut.T).reshape(new_shapes)
-
-    elif tree_object.backend == 'numpy':
-
-        node.cache_tensor.fill(0)
-        for operators in tree_object.hamiltonian:
-
-            if operators[1] > 0:
-
-                for network in node.vertical_networks:
-                    # print(network['bondspace'],operators[1])
-                    if np.allclose(operators[1], network['bondspace']):
-                        node.cache_tensor+=contract_network(operators, network)*operators[-1][0]
-
-                for network in node.horizontal_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-                        node.cache_tensor+=contract_network(operators, network)*operators[-1][1]
-            else:
-                for network in node.one_site_networks:
-                    if np.allclose(operators[1], network['bondspace']):
-                        node.cache_tensor+=contract_network(operators, network)*operators[-1][0]
-
-        new_shapes = node.cache_tensor.shape
-        u, s, v = np.linalg.svd(node.cache_tensor.reshape(new_shapes[0],
-            np.prod(new_shapes[1:])).T, full_matrices = False)
-
-        node.current_tensor =-1.*np.dot(v.T, u.T).reshape(new_shapes)
 
+def get_polar_svd(matrix, options):
+    """ polar factor of a (chi x n) matrix from its full (thin) svd """
+    if isinstance(matrix, np.ndarray):
+        u, s, v = np.linalg.svd(matrix, full_matrices=False)
+        return np.dot(u, v), {}
+    u, s, v = matrix.svd(some=True)
+    return torch.matmul(u, v.T), {}
+
+
+def get_polar_randomized_svd(matrix, options):
+    """ Polar factor from a randomized svd (Halko et al.) of the transpose of a
+        (chi x n) matrix: its range is sampled with rank+oversampling random vectors
+        and refined by power iterations. With the default rank, the full chi, the
+        result is exact up to round-off. A smaller rank only takes the leading rank
+        directions from the samples, the others come from complete_isometry() so the
+        update stays an isometry """
+    rank = min(options.get('rank') or matrix.shape[0], matrix.shape[0])
+    samples = min(rank+options.get('oversampling', 4), matrix.shape[0])
+    if isinstance(matrix, np.ndarray):
+        sample = np.dot(matrix.T, np.random.normal(size=(matrix.shape[0], samples)))
+        for i in range(options.get('power_iterations', 1)):
+            sample = np.dot(matrix.T, np.dot(matrix, np.linalg.qr(sample)[0]))
+        q = np.linalg.qr(sample)[0]
+        u, s, v = np.linalg.svd(np.dot(matrix, q), full_matrices=False)
+        u, w = u[:, :rank], np.dot(q, v[:rank].T)
+    else:
+        sample = torch.matmul(matrix.T, torch.randn(matrix.shape[0], samples, dtype=matrix.dtype,
+                                                    device=matrix.device))
+        for i in range(options.get('power_iterations', 1)):
+            sample = torch.matmul(matrix.T, torch.matmul(matrix, torch.linalg.qr(sample)[0]))
+        q = torch.linalg.qr(sample)[0]
+        u, s, v = torch.matmul(matrix, q).svd(some=True)
+        u, w = u[:, :rank], torch.matmul(q, v[:, :rank])
+    if rank < matrix.shape[0]:
+        return complete_isometry(matrix, u, w), {'rank': rank}
+    return u@w.T, {'rank': rank}
+
+
+def complete_isometry(matrix, u, w):
+    """ Isometry u w^T + u' w'^T from the leading singular vectors u (chi x r) and w
+        (n x r) of a (chi x n) matrix: u' spans the rest of the chi rows and w'^T is
+        the polar factor of u'^T matrix with the directions of w projected out, the
+        best completion given u and w """
+    if isinstance(matrix, np.ndarray):
+        rest = np.linalg.svd(u, full_matrices=True)[0][:, u.shape[1]:]
+        residual = np.dot(rest.T, matrix)
+        residual = residual-np.dot(np.dot(residual, w), w.T)
+        a, s, b = np.linalg.svd(residual, full_matrices=False)
+        return np.dot(u, w.T)+np.dot(rest, np.dot(a, b))
+    rest = torch.linalg.svd(u, full_matrices=True)[0][:, u.shape[1]:]
+    residual = rest.T@matrix
+    residual = residual-(residual@w)@w.T
+    a, s, b = torch.linalg.svd(residual, full_matrices=False)
+    return u@w.T+rest@(a@b)
+
+
+def get_polar_newton_schulz(matrix, options):
+    """ Polar factor of a (chi x n) matrix by Newton-Schulz iterations
+        X <- 1.5 X - 0.5 X X^T X, only matrix products, starting from the matrix
+        scaled by its Frobenius norm. Stops when X X^T is the identity up to
+        'tolerance' (by default a hundred times chi times the machine precision) or
+        after 'max_iterations' """
+    if isinstance(matrix, np.ndarray):
+        identity = np.eye(matrix.shape[0])
+        polar = matrix/np.linalg.norm(matrix)
+        precision = np.finfo(matrix.dtype).eps
+    else:
+        identity = torch.eye(matrix.shape[0], dtype=matrix.dtype, device=matrix.device)
+        polar = matrix/matrix.norm()
+        precision = torch.finfo(matrix.dtype).eps
+    tolerance = options.get('tolerance', 100*matrix.shape[0]*precision)
+    for iteration in range(1, options.get('max_iterations', 100)+1):
+        gram = polar@polar.T
+        if float(((gram-identity)**2).sum())**.5 < tolerance:
+            break
+        polar = 1.5*polar-.5*(gram@polar)
+    return polar, {'iterations': iteration}
+
+
+def get_update_report(matrix, polar):
+    """ Accuracy of a polar factor of matrix: how far it is from an isometry and the
+        relative gap between <polar, matrix> and its maximum, the nuclear norm of
+        matrix, reached by the exact polar factor """
+    gram = matrix@matrix.T
+    if isinstance(matrix, np.ndarray):
+        nuclear_norm = np.sqrt(np.clip(np.linalg.eigvalsh(gram), 0, None)).sum()
+        identity = np.eye(matrix.shape[0])
+    else:
+        nuclear_norm = torch.linalg.eigvalsh(gram).clamp(min=0).sqrt().sum()
+        identity = torch.eye(matrix.shape[0], dtype=matrix.dtype, device=matrix.device)
+    return {'isometry_error': float((((polar@polar.T)-identity)**2).sum())**.5,
+            'polar_error': float(1-(polar*matrix).sum()/nuclear_norm)}
+
+
+def update_tensor(tree_object, node):
+    """ New tensor of node, minus the polar factor of its environment node.cache_tensor,
+        computed with the update solver selected for the layer of node """
+    solver = tree_object.update_solver
+    if not isinstance(solver, str):
+        solver = solver[node.layer]
+    new_shapes = node.cache_tensor.shape
+    matrix = node.cache_tensor.reshape(new_shapes[0], int(np.prod(new_shapes[1:])))
+    if solver == 'svd':
+        polar, report = get_polar_svd(matrix, tree_object.solver_options)
+    elif solver == 'randomized_svd':
+        polar, report = get_polar_randomized_svd(matrix, tree_object.solver_options)
+    elif solver == 'newton_schulz':
+        polar, report = get_polar_newton_schulz(matrix, tree_object.solver_options)
+    else:
+        raise ValueError("unknown update solver '%s'"%solver)
+    if tree_object.report_updates:
+        report.update(get_update_report(matrix, polar), layer=node.layer, solver=solver)
+        tree_object.update_reports.append(report)
+    # back to the type of the contractions, see TreeTensorNetwork.set_mixed_precision()
+    node.current_tensor = cast(-1.*polar.reshape(new_shapes), node.current_tensor.dtype)
+
+
+def accumulate_environment(tree_object, node, terms):
+    """ sums the environments of the given terms of node into node.cache_tensor """
+    def contract(term, operators, network):
+        with phase(tree_object, 'environment_'+network['kind'], layer=node.layer):
+            return contract_environment(tree_object, operators, network, term)
+
+    environments = map_terms(tree_object, contract, terms)
+    with phase(tree_object, 'accumulate', layer=node.layer):
+        if tree_object.backend == 'torch':
+            node.cache_tensor.zero_()
+            for environment, (term, operators, network, coefficient) in zip(environments, terms):
+                node.cache_tensor.add_(environment*coefficient)
+        elif tree_object.backend == 'numpy':
+            node.cache_tensor.fill(0)
+            for environment, (term, operators, network, coefficient) in zip(environments, terms):
+                node.cache_tensor += environment*coefficient
+
+
+def set_layer_tensor(tree_object, layer, tensor):
+    """ all nodes within a layer share the same tensor """
     for a_node in tree_object.node_list:
-        if a_node.value == node.value:
-            a_node.current_tensor = node.current_tensor
+        if a_node.layer == layer:
+            a_node.current_tensor = tensor
+    clear_environment_cache(tree_object, layer)
+
+
+def set_environment(tree_object, node):
+    """ VOID: node.cache_tensor becomes the full environment of node """
+    if tree_object.workers:
+        # every worker returns the environment of its shard of the terms
+        with phase(tree_object, 'environment_workers', layer=node.layer):
+            for connection in tree_object.workers:
+                connection.send(('environment', node.value))
+            partial_environments = [connection.recv() for connection in tree_object.workers]
+            node.cache_tensor = cast(sum(partial_environments), node.cache_tensor.dtype)
+    else:
+        accumulate_environment(tree_object, node, get_terms(tree_object, node))
+
+
+def get_root_energy(tree_object):
+    """ Energy from the environment of the root, which is linear in the root tensor:
+        E = sum(root tensor * root environment). The environment stays in
+        root.cache_tensor and is reused by the next sweep, see optimize_tensor() """
+    root = tree_object.root
+    with phase(tree_object, 'energy', full=False):
+        set_environment(tree_object, root)
+        return float((cast(root.current_tensor, root.cache_tensor.dtype)*root.cache_tensor).sum())
+
+
+def optimize_tensor(tree_object, node, environment=True):
+    """ VOID: optimize method for a single tensor in the Tree Tensor Network using optimal einsum,
+        environment=False reuses node.cache_tensor when it is still up to date. The wall
+        time of the call is stored in tree_object.times """
+    before = time.time()
+    with phase(tree_object, 'optimize_tensor', layer=node.layer):
+        if environment:
+            set_environment(tree_object, node)
+
+        with phase(tree_object, 'update', layer=node.layer):
+            update_tensor(tree_object, node)
+        with phase(tree_object, 'propagate', layer=node.layer):
+            set_layer_tensor(tree_object, node.layer, node.current_tensor)
+            for connection in tree_object.workers:
+                connection.send(('tensor', node.layer, node.current_tensor))
+    tree_object.store_time(time.time()-before)
+
+
+def start_workers(tree_object, workers, address=None, authkey=None, spawn=True):
+    """ Starts a distributed sweep: optimize_tensor() and get_energy() shard the terms
+        of a node over the workers, which each hold a copy of tree_object and only
+        receive the new tensor of a layer after its update. With spawn the workers
+        are local processes, on a loopback address and a random authkey by default.
+        Otherwise they are started by hand, on any machine, with run_worker(address,
+        authkey), and this waits until 'workers' of them connected. That needs an
+        address the machines can reach, e.g. ('0.0.0.0', 6000), and an authkey that
+        is shared with them """
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    if not spawn:
+        if not authkey:
+            raise ValueError('workers started by hand need an explicit authkey')
+        if address is None or address[0] in ('localhost', '::1') or address[0].startswith('127.'):
+            raise ValueError('workers started by hand need an address they can reach, not %s'
+                             %(address,))
+    address = address or ('localhost', 0)
+    authkey = authkey or os.urandom(16)
+    listener = Listener(address, authkey=authkey)
+    context = multiprocessing.get_context('spawn')
+    if spawn:
+        for i in range(workers):
+            process = context.Process(target=run_worker, args=(listener.address, authkey), daemon=True)
+            process.start()
+            tree_object.worker_processes.append(process)
+    else:
+        print('waiting for %s workers at %s'%(workers, listener.address))
+    connections = [listener.accept() for i in range(workers)]
+    listener.close()
+    for shard, connection in enumerate(connections):
+        connection.send((tree_object, shard, workers))
+    tree_object.workers = connections
+
+
+def stop_workers(tree_object):
+    """ ends a distributed sweep started by start_workers() """
+    for connection in tree_object.workers:
+        connection.send(('stop',))
+        connection.close()
+    for process in tree_object.worker_processes:
+        process.join()
+    tree_object.workers, tree_object.worker_processes = [], []
+
+
+def run_worker(address, authkey):
+    """ Worker of a distributed sweep, see start_workers(). Connects to the parent at
+        address and serves the environments and energies of its shard of the terms """
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    connection = Client(address, authkey=authkey)
+    tree_object, shard, workers = connection.recv()
+    nodes = {a_node.value: a_node for a_node in tree_object.node_list}
+    while True:
+        message = connection.recv()
+        if message[0] == 'environment':
+            node = nodes[message[1]]
+            accumulate_environment(tree_object, node, get_terms(tree_object, node)[shard::workers])
+            connection.send(node.cache_tensor)
+        elif message[0] == 'energy':
+            node = nodes[message[1]]
+            connection.send(get_partial_energy(tree_object, node,
+                                               get_terms(tree_object, node)[shard::workers]))
+        elif message[0] == 'tensor':
+            set_layer_tensor(tree_object, message[1], message[2])
+        elif message[0] == 'stop':
+            connection.close()
+            return
+
+
+def sweep(tree_object, loop_length, environment=True):
+    """ VOID: optimizes root, root.left, root.left.left, ... loop_length tensors,
+        environment=False reuses the root environment left by get_root_energy() """
+    temp = tree_object.root
+    with phase(tree_object, 'sweep'):
+        for i in range(loop_length): # works better than writing it out since we recursively take the .left of current node
+            optimize_tensor(tree_object, temp, environment or i > 0)
+            temp = temp.left
 
 
 def exact_energy(N, hamiltonian, dimension):
@@ -659,6 +1868,253 @@ def exact_energy(N, hamiltonian, dimension):
         return h
 
 
+def get_site_leaves(tree_object):
+    """ {site: (leaf, leg of the site in the tensor of leaf)} """
+    if tree_object.site_leaves is None:
+        site_leaves = {}
+        for a_node in tree_object.node_list:
+            if a_node.isLeaf():
+                for position, site in enumerate(a_node.lattice.flatten()):
+                    site_leaves[int(site)] = (a_node, position+1)
+        tree_object.site_leaves = site_leaves
+    return tree_object.site_leaves
+
+
+def get_rdm_pattern(tree_object, sites):
+    """ (pattern, layers) of the nodes above sites. The pattern is the sub-tree of
+        these nodes, (left, right) per node with None for a child outside of it and
+        (leg, place in sites, leg, place, ...) per leaf, sites translated onto leaves
+        in the same way have the same pattern. layers
+        has the layer of every node of the sub-tree, in the order of the pattern """
+    site_leaves = get_site_leaves(tree_object)
+    assert len(set(sites)) == len(sites), 'sites must be distinct'
+    leaves, cone = {}, set()
+    for place, site in enumerate(sites):
+        leaf, position = site_leaves[int(site)]
+        leaves.setdefault(leaf, []).append((position, place))
+        while leaf is not None and leaf not in cone:
+            cone.add(leaf)
+            leaf = leaf.parent
+    layers = []
+
+    def describe(a_node):
+        if a_node not in cone:
+            return None
+        layers.append(a_node.layer)
+        if a_node.isLeaf():
+            return tuple(it.chain(*sorted(leaves[a_node])))
+        return (describe(a_node.left), describe(a_node.right))
+    return describe(tree_object.root), layers
+
+
+def get_rdm_legs(pattern, leaf_legs):
+    """ (legs, out) of the contraction of the sub-tree pattern (see get_rdm_pattern())
+        with an open pair of legs per site, every node of it contributes its tensor
+        twice (bra and ket) and out has the ket legs of the sites followed by their
+        bra legs. leaf_legs is the number of legs of a leaf tensor """
+    legs, kets, bras = [], {}, {}
+    labels = it.count(1)
+
+    def label(a_pattern, bra_up, ket_up):
+        bralegs, ketlegs = [bra_up], [ket_up]
+        legs.extend((bralegs, ketlegs))
+        if not isinstance(a_pattern[0], int):
+            for child in a_pattern:
+                bralegs.append(next(labels))
+                ketlegs.append(bralegs[-1] if child is None else next(labels))
+            for child, bra_leg, ket_leg in zip(a_pattern, bralegs[1:], ketlegs[1:]):
+                if child is not None:
+                    label(child, bra_leg, ket_leg)
+        else:
+            open_legs = dict(zip(a_pattern[::2], a_pattern[1::2]))
+            for position in range(1, leaf_legs):
+                bralegs.append(next(labels))
+                ketlegs.append(bralegs[-1] if position not in open_legs else next(labels))
+                if position in open_legs:
+                    bras[open_legs[position]], kets[open_legs[position]] = bralegs[-1], ketlegs[-1]
+    root_leg = next(labels)
+    label(pattern, root_leg, root_leg)
+    return legs, [kets[i] for i in sorted(kets)]+[bras[i] for i in sorted(bras)]
+
+
+def get_rdm_plan(tree_object, sites):
+    """ (plan, layers) for the reduced density matrix of sites, plans are compiled
+        once per pattern (see get_rdm_pattern()) and kept in tree_object.rdm_plans """
+    pattern, layers = get_rdm_pattern(tree_object, sites)
+    if pattern not in tree_object.rdm_plans:
+        layer_tensors = get_layer_tensors(tree_object)
+        legs, out = get_rdm_legs(pattern, len(layer_tensors[-1].shape))
+        shapes = [layer_tensors[layer].shape for layer in layers for copy in range(2)]
+        tree_object.rdm_plans[pattern] = get_expression(legs, out, shapes, tree_object.optimize_type,
+                                                        tree_object.memory_limit)
+    return tree_object.rdm_plans[pattern], layers
+
+
+def get_layer_tensors(tree_object):
+    """ the tensor of every layer """
+    layer_tensors = [None]*(tree_object.cut+1)
+    for a_node in tree_object.node_list:
+        if layer_tensors[a_node.layer] is None:
+            layer_tensors[a_node.layer] = a_node.current_tensor
+    return layer_tensors
+
+
+def get_rdm(tree_object, sites):
+    """ Reduced density matrix of sites with legs [ket of sites..., bra of sites...],
+        the expectation value of an operator O with legs [bra..., ket...] is the
+        contraction of both over all legs. Only the nodes above sites take part since
+        every tensor is an isometry, see get_rdm_plan() """
+    expression, layers = get_rdm_plan(tree_object, sites)
+    layer_tensors = get_layer_tensors(tree_object)
+    with phase(tree_object, 'rdm', sites=len(sites)):
+        return expression(*[layer_tensors[layer] for layer in layers for copy in range(2)])
+
+
+def stack_operators(tree_object, operators, dtype):
+    """ one-site operators stacked along a first leg, on the backend and device of
+        tree_object as dtype """
+    stacked = np.stack([to_backend(operator, 'numpy') for operator in operators])
+    return cast(to_backend(stacked, tree_object.backend, device=tree_object.device), dtype)
+
+
+def get_batched_expression(tree_object, legs, out, shapes):
+    """ compiled contraction of a reduced density matrix with operators, kept in
+        tree_object.rdm_plans by its equation and shapes """
+    key = (get_equation(legs, out), tuple(tuple(int(d) for d in shape) for shape in shapes))
+    if key not in tree_object.rdm_plans:
+        tree_object.rdm_plans[key] = get_expression(legs, out, shapes, tree_object.optimize_type)
+    return tree_object.rdm_plans[key]
+
+
+def get_expectation_values(tree_object, sites, operator_strings):
+    """ Expectation values of operator strings, each a list of one-site operators
+        acting on sites in order, from a single reduced density matrix of sites (see
+        get_rdm()) contracted with all strings at once """
+    rdm = get_rdm(tree_object, sites)
+    n = len(sites)
+    operators = [stack_operators(tree_object, [a_string[k] for a_string in operator_strings], rdm.dtype)
+                 for k in range(n)]
+    # rdm legs [ket..., bra...], operator legs [string, bra, ket]
+    legs = [list(range(1, 2*n+1))]+[[0, n+1+k, 1+k] for k in range(n)]
+    expression = get_batched_expression(tree_object, legs, [0], [rdm.shape]+[a.shape for a in operators])
+    with phase(tree_object, 'expectation_values', strings=len(operator_strings)):
+        return expression(rdm, *operators)
+
+
+def get_correlation_products(tree_object, sites, operators):
+    """ Expectation values of all products of operators[0][i] on sites[0],
+        operators[1][j] on sites[1], ... as an array with a leg per site, e.g. the
+        3**4 products of the spin components on a plaquette, from a single reduced
+        density matrix of sites """
+    rdm = get_rdm(tree_object, sites)
+    n = len(sites)
+    stacked = [stack_operators(tree_object, site_operators, rdm.dtype) for site_operators in operators]
+    legs = [list(range(1, 2*n+1))]+[[2*n+1+k, n+1+k, 1+k] for k in range(n)]
+    expression = get_batched_expression(tree_object, legs, range(2*n+1, 3*n+1),
+                                        [rdm.shape]+[a.shape for a in stacked])
+    with phase(tree_object, 'correlation_products', sites=n):
+        return expression(rdm, *stacked)
+
+
+def get_correlation_sums(tree_object, sites, sums):
+    """ Weighted sums of operator strings on sites, as a numpy array with one value
+        per sum. Every sum is a list of (factor, operators, term_sites), term_sites
+        a subset of sites with one operator each. All strings are evaluated on a
+        single reduced density matrix of the distinct sites, the identity on the sites
+        a string does not act on, and a string occurring more than once is contracted
+        once """
+    sites = list(dict.fromkeys(int(site) for site in sites))
+    rdm = get_rdm(tree_object, sites)
+    n = len(sites)
+    place = {site: k for k, site in enumerate(sites)}
+    identity = np.eye(rdm.shape[0])
+    strings, index, weights = [], {}, []
+    for a_sum in sums:
+        weights.append({})
+        for factor, operators, term_sites in a_sum:
+            a_string = [identity]*n
+            for operator, site in zip(operators, term_sites):
+                a_string[place[int(site)]] = operator
+            key = tuple(id(operator) for operator in a_string)
+            if key not in index:
+                index[key] = len(strings)
+                strings.append(a_string)
+            weights[-1][index[key]] = weights[-1].get(index[key], 0.)+factor
+    weight_matrix = np.zeros((len(sums), len(strings)))
+    for i, a_weights in enumerate(weights):
+        for j, factor in a_weights.items():
+            weight_matrix[i, j] = factor
+    operators = [stack_operators(tree_object, [a_string[k] for a_string in strings], rdm.dtype)
+                 for k in range(n)]
+    weight_matrix = stack_operators(tree_object, weight_matrix, rdm.dtype)
+    # rdm legs [ket..., bra...], operator legs [string, bra, ket], weights [sum, string]
+    legs = [list(range(1, 2*n+1))]+[[0, n+1+k, 1+k] for k in range(n)]+[[2*n+1, 0]]
+    expression = get_batched_expression(tree_object, legs, [2*n+1],
+                                        [rdm.shape]+[a.shape for a in operators]+[weight_matrix.shape])
+    with phase(tree_object, 'correlation_sums', strings=len(strings)):
+        return to_backend(expression(rdm, *operators, weight_matrix), 'numpy')
+
+
+def get_sum_operator(terms, sites):
+    """ weighted sum of operator strings (factor, operators, term_sites) on sites as a
+        numpy array with legs [bra of sites..., ket of sites...] """
+    n = len(sites)
+    place = {int(site): k for k, site in enumerate(sites)}
+    total = 0.
+    for factor, operators, term_sites in terms:
+        matrices = [None]*n
+        for operator, site in zip(operators, term_sites):
+            matrices[place[int(site)]] = to_backend(operator, 'numpy')
+        identity = np.eye(next(m for m in matrices if m is not None).shape[0])
+        # legs [bra, ket] per site
+        product = functools.reduce(np.multiply.outer, [identity if m is None else m for m in matrices])
+        total = total+factor*product.transpose(list(range(0, 2*n, 2))+list(range(1, 2*n, 2)))
+    return total
+
+
+def get_product_expectation_value(tree_object, blocks):
+    """ Expectation value of a product of operators acting on distinct blocks of sites,
+        blocks is a list of (operator, block_sites) with operator legs [bra of
+        block_sites..., ket of block_sites...]. From a single reduced density matrix of
+        all sites """
+    sites = [int(site) for operator, block_sites in blocks for site in block_sites]
+    rdm = get_rdm(tree_object, sites)
+    n = len(sites)
+    operators, legs, start = [], [list(range(1, 2*n+1))], 0
+    for operator, block_sites in blocks:
+        m = len(block_sites)
+        operators.append(cast(to_backend(operator, tree_object.backend, device=tree_object.device), rdm.dtype))
+        legs.append([n+1+start+k for k in range(m)]+[1+start+k for k in range(m)])
+        start += m
+    expression = get_batched_expression(tree_object, legs, [], [rdm.shape]+[a.shape for a in operators])
+    with phase(tree_object, 'product_expectation_value', sites=n):
+        return float(expression(rdm, *operators))
+
+
+def get_position_orbits(tree_object):
+    """ positions (i, j) of tree_object.root.lattice grouped into orbits of the
+        translations the state is invariant under, see get_translations(). Every
+        position is in its own orbit when there are none """
+    lattice = tree_object.root.lattice
+    position = {int(site): index for index, site in np.ndenumerate(lattice)}
+    orbits, seen = [], set()
+    for index in np.ndindex(*lattice.shape):
+        if index in seen:
+            continue
+        orbit, frontier = [index], [index]
+        seen.add(index)
+        while frontier:
+            current = frontier.pop()
+            for g in tree_object.translations:
+                image = position[int(g['sites'][lattice[current]])]
+                if image not in seen:
+                    seen.add(image)
+                    orbit.append(image)
+                    frontier.append(image)
+        orbits.append(sorted(orbit))
+    return orbits
+
+
 def rho_bot_sites(tree_object, sites, operators=None):
     """
 
@@ -673,129 +2129,11 @@ def rho_bot_sites(tree_object, sites, operators=None):
         if operators=None:   torch.cuda tensor or np.ndarray
         if operators!=None:  float32 or float64
 
+    The contraction is compiled once per pattern of sites, see get_rdm()
     """
-    temporary_network = []
-    site_legs = np.arange(1,len(sites)*2+1)*-1
-    site_bra_legs = site_legs[:int(site_legs.size/2)].astype(int).tolist()
-    site_ket_legs = site_legs[int(site_legs.size/2):].astype(int).tolist()
-    for tensor in tree_object.node_list:
-        for site in sites:
-            if site in tensor.lattice:
-                temporary_network.append(tensor)
-
-    unique_network = []
-    for i in temporary_network:
-        if i not in unique_network:
-            unique_network.append(i)
-        else:
-            continue
-
-    new_open_legs = np.arange(1, 2*(len(sites))+1)*-1
-    new_bra_open_legs, new_ket_open_legs = np.array_split(new_open_legs, 2)
-    new_bra_open_legs, new_ket_open_legs = list(reversed(new_bra_open_legs.tolist())), list(reversed(new_ket_open_legs.tolist()))
-    all_legs = []
-
-    for current_node in unique_network:
-        if current_node.isRoot():
-
-            current_node.bralegs = np.array([1,2,3])
-            current_node.ketlegs = np.array([1, None, None])
-
-            if current_node.left in unique_network and not current_node.right in unique_network:
-                current_node.ketlegs[2] = current_node.bralegs[2]
-            elif current_node.right in unique_network and not current_node.left in unique_network:
-                current_node.ketlegs[1] = current_node.bralegs[1]
-
-            mask_legs = np.where(current_node.ketlegs == None)[0]
-            new_values = np.arange(np.max(current_node.bralegs)+1,
-                np.max(current_node.bralegs)+mask_legs.size+1)
-            current_node.ketlegs[mask_legs] = new_values
-            max_leg = np.max(np.array([np.max(current_node.ketlegs), np.max(current_node.bralegs)]))
-
-        if not current_node.isRoot():
-            current_node.bralegs = [None]*len(current_node.current_tensor.shape)
-            current_node.ketlegs = [None]*len(current_node.current_tensor.shape)
-            current_node.bralegs, current_node.ketlegs = np.array(current_node.bralegs), np.array(current_node.ketlegs)
-
-            if current_node.isLeftChild():
-                current_node.bralegs[0] = current_node.parent.bralegs[1]
-                current_node.ketlegs[0] = current_node.parent.ketlegs[1]
-
-            if current_node.isRightChild():
-                current_node.bralegs[0] = current_node.parent.bralegs[2]
-                current_node.ketlegs[0] = current_node.parent.ketlegs[2]
-
-            if current_node.layer != tree_object.cut:
-                mask_legs = np.where(current_node.bralegs == None)[0]
-                new_bralegs = np.arange(max_leg+1, max_leg+mask_legs.size+1)
-                current_node.bralegs[mask_legs] = new_bralegs
-                max_leg = np.max(current_node.bralegs)
-
-            # for lower legs
-            if current_node.left in unique_network and current_node.right in unique_network:
-                mask_legs = np.where(current_node.ketlegs == None)[0]
-                current_node.ketlegs[mask_legs] = np.arange(max_leg+1, max_leg+mask_legs.size+1)
-                max_leg = np.max(current_node.ketlegs)
-
-            elif current_node.left in unique_network and not current_node.right in unique_network:
-                current_node.ketlegs[2] = current_node.bralegs[2]
-                current_node.ketlegs[1] = max_leg+1
-                max_leg = np.max(current_node.ketlegs)
-
-            elif current_node.right in unique_network and not current_node.left in unique_network:
-                current_node.ketlegs[1] = current_node.bralegs[1]
-                current_node.ketlegs[2] = max_leg+1
-                max_leg = np.max(current_node.ketlegs)
-
-            # if current_node = bottem tensor
-            elif not current_node.left in unique_network and not current_node.right in unique_network:
-                # below is from new_methods
-                for site, new_bra_leg, new_ket_leg in zip(sites, site_bra_legs, site_ket_legs):
-                    # added flatten() like in old code:
-                    if site in current_node.lattice.flatten():
-                        index_to_mask = np.where(current_node.lattice.flatten() == site)[0]+1
-                        current_node.bralegs[index_to_mask] = new_bra_leg
-                        current_node.ketlegs[index_to_mask] = new_ket_leg
-
-                for i_leg, b_leg in enumerate(current_node.ketlegs):
-                    if b_leg is None:
-                        current_node.ketlegs[i_leg] = max_leg+1
-                        current_node.bralegs[i_leg] = max_leg+1
-                        max_leg+=1
-
-        all_legs.extend((current_node.bralegs, current_node.ketlegs))
-
-    reduced_density_matrix_list = []
-    order_legs = [i for i in range(1, max_leg+1)][::-1]
-    for i in unique_network:
-        reduced_density_matrix_list.extend((i,i))
-    new_shape = 2**int(new_open_legs.size/2)
-
-    all_legs_2 = [np.copy(l) for l in all_legs]
-    tensor_list = []
-    f = [l.tolist() for l in all_legs_2]
-    k = [m for n in f for m in n]
-
-    out = np.arange(0, np.abs(np.min(k)))[::-1]
-    for s2 in all_legs_2:
-        s2+= np.abs(np.min(k))
-    new_path = []
-
-    for m,n in zip(reduced_density_matrix_list, all_legs_2):
-        new_path.append(m.current_tensor)
-        new_path.append(n)
     if operators is not None:
-        temp_op_legs = []
-        for i in range(int(len(out)/2)):
-            temp_op_legs.append([out[i], out[i+int(len(out)/2)]])
-        for m,n in zip(operators, temp_op_legs):
-            new_path.append(m)
-            new_path.append(n)
-        return oe.contract(*new_path), None
-    # og_reduced_density_matrix = oe.contract(*new_path, out, optimize='greedy').item()
-    # reduced_density_matrix = og_reduced_density_matrix.reshape(new_shape, new_shape) optimize='greedy'
-    torch.cuda.empty_cache()
-    return oe.contract(*new_path, out), None
+        return get_expectation_values(tree_object, sites, [operators])[0], None
+    return get_rdm(tree_object, sites), None
 
 def get_effective_ham_top(tree_object, layer):
     temporary_network = []
@@ -979,20 +2317,14 @@ def dimer_dimer_correlator(tree_object, operators, direction):
                 dimer_x_sites_0 =  [reshaped_lattice[i,j], reshaped_lattice[i,(j+1)%shapes[1]]]
                 dimer_x_sites_1 =  [reshaped_lattice[i, (j+half_l_x)%shapes[0]], reshaped_lattice[i, (j+half_l_x+1)%shapes[0]]]
                 temp_sites = [*dimer_x_sites_0, *dimer_x_sites_1]
-                temp_dimer_correlation_value = []
-                temp_two_point_correlation_value_0 = []
-                temp_two_point_correlation_value_1 = []
-
-                for k in all_operators_list:
-                    temp_dimer_correlation_value.append(n_point_correlator(tree_object, k, temp_sites))
-                all_dimer_dimer_correlation_value.append(np.sum(temp_dimer_correlation_value))
-
-                for k in operators:
-                    temp_two_point_correlation_value_0.append(n_point_correlator(tree_object, k, dimer_x_sites_0))
-                    temp_two_point_correlation_value_1.append(n_point_correlator(tree_object, k, dimer_x_sites_1))
-
-                all_two_point_correlation_value_0.append(np.sum(temp_two_point_correlation_value_0))
-                all_two_point_correlation_value_1.append(np.sum(temp_two_point_correlation_value_1))
+                # the dimer-dimer and both dimer values from one reduced density matrix
+                dimer_dimer, dimer_0, dimer_1 = get_correlation_sums(tree_object, temp_sites, [
+                    [(1., k, temp_sites) for k in all_operators_list],
+                    [(1., k, dimer_x_sites_0) for k in operators],
+                    [(1., k, dimer_x_sites_1) for k in operators]])
+                all_dimer_dimer_correlation_value.append(dimer_dimer)
+                all_two_point_correlation_value_0.append(dimer_0)
+                all_two_point_correlation_value_1.append(dimer_1)
 
     elif (direction == 'y') or (direction == 'Y'):
         for i in range(shapes[0]):
@@ -1000,19 +2332,14 @@ def dimer_dimer_correlator(tree_object, operators, direction):
                 dimer_y_sites_0 = [reshaped_lattice[i, j] , reshaped_lattice[(i+1)%shapes[0],j]]
                 dimer_y_sites_1 = [reshaped_lattice[(i+half_l_y)%shapes[1],j], reshaped_lattice[(i+1+half_l_y)%shapes[1], j]]
                 temp_sites = [*dimer_y_sites_0, *dimer_y_sites_1]
-                temp_dimer_correlation_value = []
-                temp_two_point_correlation_value_0 = []
-                temp_two_point_correlation_value_1 = []
-
-                for k in all_operators_list:
-                    temp_dimer_correlation_value.append(n_point_correlator(tree_object, k, temp_sites))
-                all_dimer_dimer_correlation_value.append(np.sum(temp_dimer_correlation_value))
-
-                for k in operators:
-                    temp_two_point_correlation_value_0.append(n_point_correlator(tree_object, k, dimer_y_sites_0))
-                    temp_two_point_correlation_value_1.append(n_point_correlator(tree_object, k, dimer_y_sites_1))
-                all_two_point_correlation_value_0.append(np.sum(temp_two_point_correlation_value_0))
-                all_two_point_correlation_value_1.append(np.sum(temp_two_point_correlation_value_1))
+                # the dimer-dimer and both dimer values from one reduced density matrix
+                dimer_dimer, dimer_0, dimer_1 = get_correlation_sums(tree_object, temp_sites, [
+                    [(1., k, temp_sites) for k in all_operators_list],
+                    [(1., k, dimer_y_sites_0) for k in operators],
+                    [(1., k, dimer_y_sites_1) for k in operators]])
+                all_dimer_dimer_correlation_value.append(dimer_dimer)
+                all_two_point_correlation_value_0.append(dimer_0)
+                all_two_point_correlation_value_1.append(dimer_1)
 
     return np.mean(all_dimer_dimer_correlation_value)/2, all_dimer_dimer_correlation_value, np.mean(all_two_point_correlation_value_0), np.mean(all_two_point_correlation_value_1)
 
@@ -1026,18 +2353,17 @@ def bond_correlator(tree_object, operators):
         for j in range(jrange):
             sites_x = [temp_lat[i,j], temp_lat[i,(j+1)%jrange]]
             sites_y = [temp_lat[i, j] , temp_lat[(i+1)%irange,j]]
-            temp_x, temp_y = [], []
-            for op in all_operators_2:
-                temp_x.append(n_point_correlator(tree_object, op, sites_x))
-                temp_y.append(n_point_correlator(tree_object, op, sites_y))
-            bonds_x.append(np.sum(temp_x))
-            bonds_y.append(np.sum(temp_y))
+            bonds_x.append(get_correlation_sums(tree_object, sites_x,
+                                                [[(1., op, sites_x) for op in all_operators_2]])[0])
+            bonds_y.append(get_correlation_sums(tree_object, sites_y,
+                                                [[(1., op, sites_y) for op in all_operators_2]])[0])
 
     return bonds_x, bonds_y
 
 
-def plaquette_correlator(tree_object, operators, sites):
-    """ single plaquette expectation value """
+def get_plaquette_terms(tree_object, operators, sites):
+    """ (factor, operators, sites) of the terms of the plaquette operator on sites
+        [alpha, beta, gamma, delta], see plaquette_correlator() """
     all_operators_4 = vector_correlator(tree_object, operators, 2)
     all_operators_2 = vector_correlator(tree_object, operators, 1)
 
@@ -1048,11 +2374,17 @@ def plaquette_correlator(tree_object, operators, sites):
     orders2 = [[alpha, beta], [gamma, delta], [alpha, delta], [beta, gamma], [alpha, gamma], [beta, delta]]
     for operator in all_operators_4:
         for order, sign in zip(orders4, signs4):
-            plaquettes.append(sign*n_point_correlator(tree_object, operator, order))
+            plaquettes.append((sign, operator, order))
     for operator in all_operators_2:
         for order in orders2:
-            plaquettes.append(.5*n_point_correlator(tree_object, operator, order))
-    return np.sum(plaquettes)
+            plaquettes.append((.5, operator, order))
+    return plaquettes
+
+
+def plaquette_correlator(tree_object, operators, sites):
+    """ single plaquette expectation value """
+    # all terms from a single reduced density matrix of the plaquette
+    return get_correlation_sums(tree_object, sites, [get_plaquette_terms(tree_object, operators, sites)])[0]
 
 
 def compute_correlation_product(operator_list, power):
@@ -1079,130 +2411,67 @@ def plaquette_correlators(tree_object, start_operators):
     return all_plaquettes
 
 
-def plaquette_plaquette_correlator(tree_object, operators):
-    all_operators_8 = vector_correlator(tree_object, operators, 4)
-    all_operators_6 = vector_correlator(tree_object, operators, 3)
-
-    all_operators_4 = vector_correlator(tree_object, operators, 2)
-    all_operators_2 = vector_correlator(tree_object, operators, 1)
+def plaquette_plaquette_correlator(tree_object, operators, printf=True):
+    """ Correlations of the plaquette at every position with the one half the lattice
+        away in x and in y, returns (mean x, mean y, y values, x values, squared mean
+        plaquette, products of the plaquettes in x, products of the plaquettes in y).
+        A product of two plaquette operators Q (see plaquette_correlator()) holds all
+        8, 6, 4 and 2-point terms, so every value is <Q Q'> + .25*(<Q> + <Q'>) from a
+        single reduced density matrix. Only one position per orbit of the
+        translations of the state (see get_position_orbits()) is evaluated, the
+        positions are spread over tree_object.threads threads and with printf the
+        running means are printed as they come in """
     reshaped_lattice = tree_object.root.lattice
     shapes = reshaped_lattice.shape
-    # x direction
     half_l_x = int(shapes[0]/2)
     half_l_y = int(shapes[1]/2)
-    # x-direction
+
+    def plaquette(i, j):
+        i, j = i%shapes[0], j%shapes[1]
+        return [reshaped_lattice[i, j], reshaped_lattice[i, (j+1)%shapes[1]],
+                reshaped_lattice[(i+1)%shapes[0], (j+1)%shapes[1]], reshaped_lattice[(i+1)%shapes[0], j]]
+
+    # the plaquette operator, the same for every plaquette, legs in the order of plaquette()
+    plaquette_operator = get_sum_operator(get_plaquette_terms(tree_object, operators, [0, 1, 2, 3]),
+                                          [0, 1, 2, 3])
+    orbits = get_position_orbits(tree_object)
+    orbit_of = {index: k for k, orbit in enumerate(orbits) for index in orbit}
+
+    def single(i, j):
+        return get_product_expectation_value(tree_object, [(plaquette_operator, plaquette(i, j))])
+    singles = list(map_tasks(tree_object, single, [orbit[0] for orbit in orbits]))
+    single_at = lambda i, j: singles[orbit_of[(i%shapes[0], j%shapes[1])]]
+
+    def pair(i, j):
+        values = []
+        for di, dj in ((0, half_l_x), (half_l_y, 0)):
+            values.append(get_product_expectation_value(tree_object, [(plaquette_operator, plaquette(i, j)),
+                                                                      (plaquette_operator, plaquette(i+di, j+dj))])
+                          + .25*(single_at(i, j)+single_at(i+di, j+dj)))
+        return values
+    pairs, done, sum_x, sum_y = [], 0, 0., 0.
+    for orbit, values in zip(orbits, map_tasks(tree_object, pair, [orbit[0] for orbit in orbits])):
+        pairs.append(values)
+        done += len(orbit)
+        sum_x, sum_y = sum_x+len(orbit)*values[0], sum_y+len(orbit)*values[1]
+        if printf:
+            print('plaquette pairs %s/%s: running mean x %s, y %s'%(done, reshaped_lattice.size,
+                                                                    sum_x/done, sum_y/done))
+
     mean_squared_plaquettes_x = []
     mean_squared_plaquettes_y = []
     x_plaquettes = []
     y_plaquettes = []
     for i in range(shapes[0]):
         for j in range(shapes[1]):
-            print('working on %s-%s'%(i,j))
-            x_temp_plaquette, y_temp_plaquette = [], []
-            i_0 = reshaped_lattice[i, j]
-            j_0 = reshaped_lattice[i, (j+1)%shapes[1]]
-            k_0 = reshaped_lattice[(i+1)%shapes[0], (j+1)%shapes[1]]
-            l_0 = reshaped_lattice[(i+1)%shapes[0], j]
-            m_x = reshaped_lattice[i, (j+half_l_x)%shapes[0]]
-            n_x = reshaped_lattice[i, (j+half_l_x+1)%shapes[0]]
-            o_x = reshaped_lattice[(i+1)%shapes[1], (j+half_l_x+1)%shapes[0]]
-            p_x = reshaped_lattice[(i+1)%shapes[1], (j+half_l_x)%shapes[0]]
-            m_y = reshaped_lattice[(i+half_l_y)%shapes[1], j]
-            n_y = reshaped_lattice[(i+half_l_y)%shapes[1], (j+1)%shapes[0]]
-            o_y = reshaped_lattice[(i+half_l_y+1)%shapes[1], (j+1)%shapes[0]]
-            p_y = reshaped_lattice[(i+half_l_y+1)%shapes[1], j]
-            indices_8_x = [[i_0,j_0,k_0,l_0,m_x,n_x,o_x,p_x], [i_0,j_0,k_0,l_0,m_x,p_x,n_x,o_x], [i_0,j_0,k_0,l_0,m_x,o_x,n_x,p_x], # correct
-                           [i_0,l_0,j_0,k_0,m_x,n_x,o_x,p_x], [i_0,l_0,j_0,k_0,m_x,p_x,n_x,o_x], [i_0,l_0,j_0,k_0,m_x,o_x,n_x,p_x], #
-                           [i_0,k_0,j_0,l_0,m_x,n_x,o_x,p_x], [i_0,k_0,j_0,l_0,m_x,p_x,n_x,o_x], [i_0,k_0,j_0,l_0,m_x,o_x,n_x,p_x]]
-            indices_6_x = [[i_0,j_0,k_0,l_0,m_x,n_x], [i_0,j_0,k_0,l_0,o_x,p_x], [i_0,j_0,k_0,l_0,m_x,p_x], [i_0,j_0,k_0,l_0,n_x,o_x],
-                           [i_0,j_0,k_0,l_0,m_x,o_x], [i_0,j_0,k_0,l_0,n_x,p_x],
-                           [i_0,l_0,j_0,k_0,m_x,n_x], [i_0,l_0,j_0,k_0,o_x,p_x], [i_0,l_0,j_0,k_0,m_x,p_x], [i_0,l_0,j_0,k_0,n_x,o_x],
-                           [i_0,l_0,j_0,k_0,m_x,o_x], [i_0,l_0,j_0,k_0,n_x,p_x],
-                           [i_0,k_0,j_0,l_0,m_x,n_x], [i_0,k_0,j_0,l_0,o_x,p_x], [i_0,k_0,j_0,l_0,m_x,p_x], [i_0,k_0,j_0,l_0,n_x,o_x],
-                           [i_0,k_0,j_0,l_0,m_x,o_x], [i_0,k_0,j_0,l_0,n_x,p_x],
-                           [i_0,j_0,m_x,n_x,o_x,p_x], [i_0,j_0,m_x,p_x,n_x,o_x], [i_0,j_0,m_x,o_x,n_x,p_x],
-                           [k_0,l_0,m_x,n_x,o_x,p_x], [k_0,l_0,m_x,p_x,n_x,o_x], [k_0,l_0,m_x,o_x,n_x,p_x],
-                           [i_0,l_0,m_x,n_x,o_x,p_x], [i_0,l_0,m_x,p_x,n_x,o_x], [i_0,l_0,m_x,o_x,n_x,p_x],
-                           [j_0,k_0,m_x,n_x,o_x,p_x], [j_0,k_0,m_x,p_x,n_x,o_x], [j_0,k_0,m_x,o_x,n_x,p_x],
-                           [i_0,k_0,m_x,n_x,o_x,p_x], [i_0,k_0,m_x,p_x,n_x,o_x], [i_0,k_0,m_x,o_x,n_x,p_x],
-                           [j_0,l_0,m_x,n_x,o_x,p_x], [j_0,l_0,m_x,p_x,n_x,o_x], [j_0,l_0,m_x,o_x,n_x,p_x]]
-            indices_4_x = [[i_0,j_0,k_0,l_0], [i_0,l_0,j_0,k_0], [i_0,k_0,j_0,l_0], [m_x,n_x,o_x,p_x], [m_x,p_x,n_x,o_x], [m_x,o_x,n_x,p_x],
-                           [i_0,j_0,m_x,n_x], [i_0,j_0,n_x,o_x], [i_0,j_0,m_x,o_x], [i_0,j_0,n_x,p_x], [i_0,j_0,o_x,p_x], [i_0,j_0,m_x,p_x],
-                           [k_0,l_0,m_x,n_x], [k_0,l_0,n_x,o_x], [k_0,l_0,m_x,o_x], [k_0,l_0,n_x,p_x], [k_0,l_0,o_x,p_x], [k_0,l_0,m_x,p_x],
-                           [i_0,l_0,m_x,n_x], [i_0,l_0,n_x,o_x], [i_0,l_0,m_x,o_x], [i_0,l_0,n_x,p_x], [i_0,l_0,o_x,p_x], [i_0,l_0,m_x,p_x],
-                           [j_0,k_0,m_x,n_x], [j_0,k_0,n_x,o_x], [j_0,k_0,m_x,o_x], [j_0,k_0,n_x,p_x], [j_0,k_0,o_x,p_x], [j_0,k_0,m_x,p_x],
-                           [i_0,k_0,m_x,n_x], [i_0,k_0,n_x,o_x], [i_0,k_0,m_x,o_x], [i_0,k_0,n_x,p_x], [i_0,k_0,o_x,p_x], [i_0,k_0,m_x,p_x],
-                           [j_0,l_0,m_x,n_x], [j_0,l_0,n_x,o_x], [j_0,l_0,m_x,o_x], [j_0,l_0,n_x,p_x], [j_0,l_0,o_x,p_x], [j_0,l_0,m_x,p_x]]
-            indices_2_x = [[i_0,j_0], [k_0,l_0], [i_0,l_0], [j_0,k_0], [i_0,k_0], [j_0,l_0], [m_x,n_x], [o_x,p_x], [m_x,p_x], [n_x,o_x], [m_x,o_x], [n_x, p_x]]
-            indices_8_y = [[i_0,j_0,k_0,l_0,m_y,n_y,o_y,p_y], [i_0,j_0,k_0,l_0,m_y,p_y,n_y,o_y], [i_0,j_0,k_0,l_0,m_y,o_y,n_y,p_y],
-                           [i_0,l_0,j_0,k_0,m_y,n_y,o_y,p_y], [i_0,l_0,j_0,k_0,m_y,p_y,n_y,o_y], [i_0,l_0,j_0,k_0,m_y,o_y,n_y,p_y],
-                           [i_0,k_0,j_0,l_0,m_y,n_y,o_y,p_y], [i_0,k_0,j_0,l_0,m_y,p_y,n_y,o_y], [i_0,k_0,j_0,l_0,m_y,o_y,n_y,p_y]]
-            indices_6_y = [[i_0,j_0,k_0,l_0,m_y,n_y], [i_0,j_0,k_0,l_0,o_y,p_y], [i_0,j_0,k_0,l_0,m_y,p_y], [i_0,j_0,k_0,l_0,n_y,o_y],
-                           [i_0,j_0,k_0,l_0,m_y,o_y], [i_0,j_0,k_0,l_0,n_y,p_y],
-                           [i_0,l_0,j_0,k_0,m_y,n_y], [i_0,l_0,j_0,k_0,o_y,p_y], [i_0,l_0,j_0,k_0,m_y,p_y], [i_0,l_0,j_0,k_0,n_y,o_y],
-                           [i_0,l_0,j_0,k_0,m_y,o_y], [i_0,l_0,j_0,k_0,n_y,p_y],
-                           [i_0,k_0,j_0,l_0,m_y,n_y], [i_0,k_0,j_0,l_0,o_y,p_y], [i_0,k_0,j_0,l_0,m_y,p_y], [i_0,k_0,j_0,l_0,n_y,o_y],
-                           [i_0,k_0,j_0,l_0,m_y,o_y], [i_0,k_0,j_0,l_0,n_y,p_y],
-                           [i_0,j_0,m_y,n_y,o_y,p_y], [i_0,j_0,m_y,p_y,n_y,o_y], [i_0,j_0,m_y,o_y,n_y,p_y],
-                           [k_0,l_0,m_y,n_y,o_y,p_y], [k_0,l_0,m_y,p_y,n_y,o_y], [k_0,l_0,m_y,o_y,n_y,p_y],
-                           [i_0,l_0,m_y,n_y,o_y,p_y], [i_0,l_0,m_y,p_y,n_y,o_y], [i_0,l_0,m_y,o_y,n_y,p_y],
-                           [j_0,k_0,m_y,n_y,o_y,p_y], [j_0,k_0,m_y,p_y,n_y,o_y], [j_0,k_0,m_y,o_y,n_y,p_y],
-                           [i_0,k_0,m_y,n_y,o_y,p_y], [i_0,k_0,m_y,p_y,n_y,o_y], [i_0,k_0,m_y,o_y,n_y,p_y],
-                           [j_0,l_0,m_y,n_y,o_y,p_y], [j_0,l_0,m_y,p_y,n_y,o_y], [j_0,l_0,m_y,o_y,n_y,p_y]]
-            indices_4_y = [[i_0,j_0,k_0,l_0], [i_0,l_0,j_0,k_0], [i_0,k_0,j_0,l_0], [m_y,n_y,o_y,p_y], [m_y,p_y,n_y,o_y], [m_y,o_y,n_y,p_y],
-                           [i_0,j_0,m_y,n_y], [i_0,j_0,n_y,o_y], [i_0,j_0,m_y,o_y], [i_0,j_0,n_y,p_y], [i_0,j_0,o_y,p_y], [i_0,j_0,m_y,p_y],
-                           [k_0,l_0,m_y,n_y], [k_0,l_0,n_y,o_y], [k_0,l_0,m_y,o_y], [k_0,l_0,n_y,p_y], [k_0,l_0,o_y,p_y], [k_0,l_0,m_y,p_y],
-                           [i_0,l_0,m_y,n_y], [i_0,l_0,n_y,o_y], [i_0,l_0,m_y,o_y], [i_0,l_0,n_y,p_y], [i_0,l_0,o_y,p_y], [i_0,l_0,m_y,p_y],
-                           [j_0,k_0,m_y,n_y], [j_0,k_0,n_y,o_y], [j_0,k_0,m_y,o_y], [j_0,k_0,n_y,p_y], [j_0,k_0,o_y,p_y], [j_0,k_0,m_y,p_y],
-                           [i_0,k_0,m_y,n_y], [i_0,k_0,n_y,o_y], [i_0,k_0,m_y,o_y], [i_0,k_0,n_y,p_y], [i_0,k_0,o_y,p_y], [i_0,k_0,m_y,p_y],
-                           [j_0,l_0,m_y,n_y], [j_0,l_0,n_y,o_y], [j_0,l_0,m_y,o_y], [j_0,l_0,n_y,p_y], [j_0,l_0,o_y,p_y], [j_0,l_0,m_y,p_y]]
-            indices_2_y = [[i_0,j_0], [k_0,l_0], [i_0,l_0], [j_0,k_0], [i_0,k_0], [j_0,l_0], [m_y,n_y], [o_y,p_y], [m_y,p_y], [n_y,o_y], [m_y,o_y], [n_y, p_y]]
-            factors_8 = [4,4,-4,4,4,-4,-4,-4,4]
-            factors_6 = [1,1,1,1,1,1,1,1,1,1,1,1,-1,-1,-1,-1,-1,-1,1,1,-1,1,1,-1,1,1,-1,1,1,-1,1,1,-1,1,1,-1]
-            factors_4 = [.5,.5,-.5,.5,.5,-.5,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25,.25]
-            # forgot that .5*.25 = .125 instead of .5, omegalul
-            factors_2 = [.125,.125,.125,.125,.125,.125,.125,.125,.125,.125,.125,.125]
-
-            for k in all_operators_8:
-                for index_8_x, index_8_y, factor_8 in zip(indices_8_x, indices_8_y, factors_8):
-                    # print('working on: ', index_8_x)
-                    x_temp_plaquette.append(factor_8*n_point_correlator(tree_object, k, index_8_x))
-                    # print('working on: ', index_8_y)
-                    y_temp_plaquette.append(factor_8*n_point_correlator(tree_object, k, index_8_y))
-                    torch.cuda.empty_cache()
-            for k in all_operators_6:
-                for index_6_x, index_6_y, factor_6 in zip(indices_6_x, indices_6_y, factors_6):
-                    # print('working on: ', index_6_x)
-                    x_temp_plaquette.append(factor_6*n_point_correlator(tree_object, k, index_6_x))
-                    # print('working on: ', index_6_y)
-                    y_temp_plaquette.append(factor_6*n_point_correlator(tree_object, k, index_6_y))
-                torch.cuda.empty_cache()
-            for k in all_operators_4:
-                for index_4_x, index_4_y, factor_4 in zip(indices_4_x, indices_4_y, factors_4):
-                    # print('working on: ', index_4_x)
-                    x_temp_plaquette.append(factor_4*n_point_correlator(tree_object, k, index_4_x))
-                    # print('working on: ', index_4_y)
-                    y_temp_plaquette.append(factor_4*n_point_correlator(tree_object, k, index_4_y))
-                    torch.cuda.empty_cache()
-            for k in all_operators_2:
-                for index_2_x, index_2_y, factor_2 in zip(indices_2_x, indices_2_y, factors_2):
-                    # print('working on: ', index_2_x)
-                    x_temp_plaquette.append(factor_2*n_point_correlator(tree_object, k, index_2_x))
-                    # print('working on: ', index_2_y)
-                    y_temp_plaquette.append(factor_2*n_point_correlator(tree_object, k, index_2_y))
-                    torch.cuda.empty_cache()
-
-            x_plaquettes.append(np.sum(x_temp_plaquette))
-            y_plaquettes.append(np.sum(y_temp_plaquette))
-            mean_squared_plaquettes_x.append(plaquette_correlator(tree_object, operators, [i_0, j_0, k_0, l_0])*plaquette_correlator(tree_object, operators, [m_x, n_x, o_x, p_x]))
-            mean_squared_plaquettes_y.append(plaquette_correlator(tree_object, operators, [i_0, j_0, k_0, l_0])*plaquette_correlator(tree_object, operators, [m_y, n_y, o_y, p_y]))
-
-            torch.cuda.empty_cache()
-        torch.cuda.empty_cache()
+            x_plaquettes.append(pairs[orbit_of[(i, j)]][0])
+            y_plaquettes.append(pairs[orbit_of[(i, j)]][1])
+            mean_squared_plaquettes_x.append(single_at(i, j)*single_at(i, j+half_l_x))
+            mean_squared_plaquettes_y.append(single_at(i, j)*single_at(i+half_l_y, j))
 
     x_plaquettes.append(.125**2)
     y_plaquettes.append(.125**2)
-    mean_squared_plaquette = np.mean(plaquette_correlators(tree_object, operators))**2
+    mean_squared_plaquette = np.mean([single_at(i, j)+.125 for i, j in np.ndindex(*shapes)])**2
 
     # commented out y_plaquettes
     return np.mean(x_plaquettes), np.mean(y_plaquettes), y_plaquettes, x_plaquettes, mean_squared_plaquette, mean_squared_plaquettes_x, mean_squared_plaquettes_y
@@ -1250,42 +2519,83 @@ def mean_two_point_correlator_i_ir(tree_object, operators, correct_magnetization
     return mean_correlation, mean_magnetization
 
 
-def optimize_network(tree_object, probe_length, var_error, max_iterations, printf = False, exact = False):
-    variance_error = 10
-    counter = 0
-    probed_energies = []
+def optimize_network(tree_object, probe_length, var_error, max_iterations, printf = False, exact = False,
+                     workers = None, energy_check = None, checkpoint = None, checkpoint_sweeps = None,
+                     checkpoint_seconds = None, resume = False, worker_address = None,
+                     worker_authkey = None, spawn_workers = True):
+    """ Sweeps until the variance of the last probe_length energies drops below var_error,
+        with workers the sweeps are distributed over that many processes, local ones
+        unless spawn_workers is False, at worker_address with worker_authkey, see
+        start_workers(). The energy after a sweep comes from the root environment, see
+        get_root_energy(), with energy_check every that many sweeps the full get_energy()
+        is contracted as well and replaces it. With checkpoint a file name, the state is
+        stored every checkpoint_sweeps sweeps and/or checkpoint_seconds seconds, see
+        store_checkpoint(), and with resume a run continues from that file if it exists """
+    if workers:
+        start_workers(tree_object, workers, worker_address, worker_authkey, spawn_workers)
+        try:
+            return optimize_network(tree_object, probe_length, var_error, max_iterations, printf, exact,
+                                    energy_check=energy_check, checkpoint=checkpoint,
+                                    checkpoint_sweeps=checkpoint_sweeps,
+                                    checkpoint_seconds=checkpoint_seconds, resume=resume)
+        finally:
+            stop_workers(tree_object)
+    state = {'variance_error': 10, 'counter': 0, 'probed_energies': []}
+    if resume and checkpoint and os.path.exists(checkpoint):
+        state = load_checkpoint(tree_object, checkpoint)
+        for connection in tree_object.workers:
+            for layer in range(tree_object.cut+1):
+                connection.send(('tensor', layer, [a_node for a_node in tree_object.node_list
+                                                   if a_node.layer == layer][0].current_tensor))
+    variance_error = state['variance_error']
+    counter = state['counter']
+    probed_energies = list(state['probed_energies'])
     if exact:
         loop_length = 1
     else:
         loop_length = tree_object.cut+1
-    for j in range(probe_length):
-        # begin 1 sweep
-        temp = tree_object.root
-        for i in range(loop_length): # works better than writing it out since we recursively take the .left of current node
-            optimize_tensor(tree_object, temp)
-            temp = temp.left
-        # end one sweep
-        probed_energies.append(get_energy(tree_object, tree_object.root))
+    sweeps, last_checkpoint = 0, time.time()
+
+    def store(probed_energies):
+        """ stores a checkpoint when one is due """
+        nonlocal sweeps, last_checkpoint
+        sweeps += 1
+        if not checkpoint:
+            return
+        if ((checkpoint_sweeps and sweeps%checkpoint_sweeps == 0) or
+                (checkpoint_seconds and time.time()-last_checkpoint > checkpoint_seconds)):
+            store_checkpoint(tree_object, checkpoint, {'variance_error': variance_error, 'counter': counter,
+                                                       'probed_energies': list(probed_energies)})
+            last_checkpoint = time.time()
+
+    fresh = False # root.cache_tensor holds the environment of the current tensors
+    for j in range(len(probed_energies), probe_length):
+        sweep(tree_object, loop_length, not fresh)
+        probed_energies.append(get_root_energy(tree_object))
+        fresh = True
+        store(probed_energies)
     probed_energies = np.array(probed_energies, dtype = 'float64')
     while(variance_error > var_error):
         probed_energies = np.roll(probed_energies, -1)
-        temp = tree_object.root
-        for i in range(loop_length):
-            optimize_tensor(tree_object, temp)
-            temp = temp.left
-        # end one sweep
-        temp_energy = get_energy(tree_object, tree_object.root)
+        sweep(tree_object, loop_length, not fresh)
+        fresh = True
+        temp_energy = get_root_energy(tree_object)
+        if energy_check and (counter+1)%energy_check == 0:
+            full_energy = get_energy(tree_object, tree_object.root)
+            if printf:
+                print('full energy:', full_energy, ' difference:', full_energy-temp_energy)
+            temp_energy = full_energy
         probed_energies[-1] = temp_energy
         variance_error = np.var(probed_energies)
 
         tree_object.energy_per_sweep_list.append(temp_energy)
         delta_energy = np.abs(np.abs(probed_energies[-1])-np.abs(probed_energies[-2]))
-        # print(probed_energies, get_energy_v2(tree_object, tree_object.root))
         if printf:
             print('var error:', variance_error,
             ' delta E:', np.abs(probed_energies[-1])-np.abs(probed_energies[-2]),
-            ' energy: ',get_energy(tree_object, tree_object.root))
+            ' energy: ',temp_energy)
         counter += 1
+        store(probed_energies)
         if max_iterations != None:
             if (counter > max_iterations) or (np.abs(delta_energy)<1e-15):
                 print('ended with variance:', variance_error)
@@ -1294,3 +2604,4 @@ def optimize_network(tree_object, probe_length, var_error, max_iterations, print
 
     print('converged up to variance of:%s at iteration %s'%(variance_error, counter))
     return
+